@@ -0,0 +1,127 @@
+"""micro-benchmark of the html report rendering
+
+   renders synthetic transcript messages, without discord or network access
+   python bench/bench_htm_gen.py [--messages 10000] [--images 0.1]
+"""
+
+import os
+import io
+import sys
+import time
+import random
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.data import TranscriptMessage
+from util import htm_gen
+from util.ndjsonExport import NdjsonExporter
+
+
+victim_id = 1001
+offender_id = 1002
+steward_id = 1003
+bot_id = 1004
+steward_role_id = 2001
+
+
+class _LocalImages:
+    """serves the same png for every attachment, the benchmark measures the rendering only"""
+
+    content = b'\x89PNG\r\n\x1a\n' + bytes(32 * 1024)
+
+    async def fetch(self, url):
+        return self.content
+
+
+def _gen_messages(count, image_ratio, seed=0):
+    rnd = random.Random(seed)
+    start = datetime(2021, 6, 1, 20, 0)
+
+    authors = [victim_id, offender_id, steward_id, bot_id, 1005]
+    messages = []
+
+    for i in range(count):
+        author_id = rnd.choice(authors)
+
+        embeds = []
+        if author_id == bot_id:
+            embeds.append({
+                'type': 'rich',
+                'title': 'Incident Summary',
+                'description': 'Race 3, Lap 12, Turn 1',
+                'fields': [{'name': f'field {n}', 'value': 'lorem ipsum ' * 4} for n in range(6)]
+            })
+
+        attachments = []
+        if rnd.random() < image_ratio:
+            attachments.append({'filename': f'proof_{i}.png', 'url': f'https://localhost/{i}.png'})
+
+        messages.append(TranscriptMessage({
+            'm_id': 10**17 + i,
+            'channel_id': 42,
+            'author_id': author_id,
+            'author_name': f'driver {author_id}',
+            'author_avatar': 'a1b2c3d4e5f6',
+            'author_roles': [steward_role_id] if author_id == steward_id else [],
+            'created_at': start + timedelta(seconds=15 * i),
+            'content': '\n'.join('message {:d} line {:d} '.format(i, n) * 3 for n in range(rnd.randint(1, 4))),
+            'embeds': embeds,
+            'attachments': attachments
+        }))
+
+    return messages
+
+
+async def _iter(messages):
+    for msg in messages:
+        yield msg
+
+
+def bench_gen_message(messages):
+    start = time.perf_counter()
+
+    for msg in messages:
+        role = htm_gen.get_author_role(msg, victim_id, offender_id, steward_role_id, bot_id)
+        htm_gen._gen_message(msg, role, ['img' for _ in msg.attachments])
+
+    return time.perf_counter() - start
+
+
+def bench_write_html_report(messages, exporters):
+    fp = io.StringIO()
+
+    start = time.perf_counter()
+    asyncio.run(htm_gen.write_html_report(fp, _LocalImages(), _iter(messages),
+                                          victim_id, offender_id, steward_role_id, bot_id,
+                                          exporters=exporters))
+    elapsed = time.perf_counter() - start
+
+    return elapsed, fp.tell()
+
+
+def _print(name, elapsed, count, extra=''):
+    print(f'{name:<28} {elapsed*1000:9.1f} ms  {elapsed/count*1e6:8.1f} us/msg  {extra}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--images', type=float, default=0.1, help='share of messages with an image attachment')
+    args = parser.parse_args()
+
+    messages = _gen_messages(args.messages, args.images)
+
+    _print('_gen_message', bench_gen_message(messages), len(messages))
+
+    elapsed, size = bench_write_html_report(messages, [])
+    _print('write_html_report', elapsed, len(messages), f'{size/2**20:.1f} MiB')
+
+    elapsed, size = bench_write_html_report(messages, [NdjsonExporter(io.StringIO())])
+    _print('write_html_report + ndjson', elapsed, len(messages), f'{size/2**20:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
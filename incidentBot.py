@@ -49,11 +49,11 @@ async def on_slash_command_error(ctx, error):
 
 @client.event
 async def on_guild_remove(guild):
-    TinyConnector._delete_guild(guild.id)
+    await TinyConnector._delete_guild(guild.id)
 
 
 def main():
-    TinyConnector.init()
+    client.loop.run_until_complete(TinyConnector.init())
     client.load_extension(f'modules.IncidentModule')
     client.load_extension(f'modules.IncidentSetup')
     client.load_extension(f'modules.IncidentSettings')
@@ -1,5 +1,5 @@
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 from enum import Enum
 
 
@@ -25,7 +25,37 @@ class State(Enum):
     CLOSED_PHASE = 7
 
 
-class Driver:
+# time without new messages, after which the incident is advanced automatically
+# closed incidents are deleted after the timeout, counted from locked_time
+STATE_TIMEOUTS = {
+    State.VICTIM_STATEMENT: timedelta(hours=1),
+    State.VICTIM_PROOF: timedelta(hours=2),
+    State.OFFENDER_STATEMENT: timedelta(days=1),
+    State.OFFENDER_PROOF: timedelta(hours=2),
+    State.STEWARD_STATEMENT: timedelta(days=5),
+    State.DISCUSSION_PHASE: timedelta(days=2),
+    State.CLOSED_PHASE: timedelta(days=2)
+}
+
+
+class _ChangeTracker:
+    """records the name of every public attribute
+       which is assigned after _clear_changes()
+
+       in-place modifications (e.g. list.append) are not detected
+    """
+
+    def __setattr__(self, name, value):
+        if not name.startswith('_'):
+            self.__dict__.setdefault('_dirty', set()).add(name)
+
+        super().__setattr__(name, value)
+
+    def _clear_changes(self):
+        self._dirty = set()
+
+
+class Driver(_ChangeTracker):
     def __init__(self, json={}):
 
         if not json:
@@ -35,17 +65,26 @@ class Driver:
         self.number = json.get('number', 0)
         self.u_id = int(json.get('u_id', 0))
 
+        self._clear_changes()
+
+    def _get_changes(self, prefix: str):
+        """returns the modified fields in dot-notation,
+           prefixed with the name of the driver field
+        """
+        d = self._to_json()
+        return {f'{prefix}.{field}': d[field] for field in self._dirty}
+
     def _to_json(self):
         d = dict()
 
         d['name'] = self.name
         d['number'] = self.number
-        d['u_id'] = str(self.u_id)
+        d['u_id'] = self.u_id
 
         return d
 
 
-class Incident:
+class Incident(_ChangeTracker):
     def __init__(self, json={}):
 
         if not json:
@@ -68,11 +107,81 @@ class Incident:
 
         self.cleanup_queue = list(map(int, json.get('cleanup_queue', [])))
 
+        # incremented by the db on every update, used for compare-and-swap
+        self.version = json.get('version', 0)
+
+        # computed by get_deadline on every update, indexed for the timeout scheduler
+        self.next_deadline = json.get('next_deadline', None)
+
+        # true, if all messages are captured in the transcript store since the channel was created
+        # incidents opened before the transcript store existed are exported from the channel history
+        self.transcript = json.get('transcript', False)
+
+        # incidents loaded from the db can be updated with field-level diffs
+        self._persisted = '_id' in json
+        self._clear_changes()
+
+    def _clear_changes(self):
+        super()._clear_changes()
+        self.victim._clear_changes()
+        self.offender._clear_changes()
+
+    def get_deadline(self):
+        """point in time at which the incident times out in its current state
+           None, if the state has no timeout
+
+           new messages extend the deadline of all states but the closed one
+        """
+
+        timeout = STATE_TIMEOUTS.get(self.state, None)
+
+        if timeout is None:
+            return None
+
+        if self.state == State.CLOSED_PHASE:
+            return self.locked_time + timeout if self.locked_time else None
+
+        return self.last_msg + timeout
+
+    def _update_deadline(self, now: datetime):
+        """called before the incident is written
+           a state change counts as activity, the timeout of the new state starts with the transition
+           otherwise the loaded (possibly day old) last_msg would make the new state due immediately
+
+           Returns: the deadline of the current state
+        """
+
+        if 'state' in self._dirty:
+            self.last_msg = now
+
+        deadline = self.get_deadline()
+
+        # only written if changed
+        if deadline != self.next_deadline:
+            self.next_deadline = deadline
+
+        return deadline
+
+    def _get_changes(self):
+        """returns a $set document of all fields
+           modified since loading the incident
+        """
+
+        d = self._to_json()
+        changes = {field: d[field] for field in self._dirty}
+
+        # replaced drivers are already included as a whole
+        for name in ['victim', 'offender']:
+            if name not in self._dirty:
+                changes.update(getattr(self, name)._get_changes(name))
+
+        return changes
+
     def _to_json(self):
 
         d = dict({
-            'g_id': str(self.g_id),  # must be set, cannot be None
-            'channel_id': str(self.channel_id),
+            'g_id': self.g_id,  # must be set, cannot be None
+            'channel_id': self.channel_id,
             'lap': self.lap,
             'race_name': self.race_name,
             'infringement': self.infringement,
@@ -80,7 +189,10 @@ class Incident:
             'state': self.state.value,
             'last_msg': self.last_msg,
             'locked_time': self.locked_time,
-            'cleanup_queue': list(map(str, self.cleanup_queue)),
+            'version': self.version,
+            'next_deadline': self.next_deadline,
+            'transcript': self.transcript,
+            'cleanup_queue': list(self.cleanup_queue),
             'victim': self.victim._to_json(),
             'offender': self.offender._to_json()
         })
@@ -103,11 +215,88 @@ class Settings:
 
     def _to_json(self):
         d = dict({
-            'g_id': str(self.g_id),  # must not be None
-            'incident_section_id': str(self.incident_section_id) if self.incident_section_id else None,
-            'stewards_id': str(self.stewards_id) if self.stewards_id else None,
-            'statement_ch_id': str(self.statement_ch_id) if self.statement_ch_id else None,
-            'log_ch_id': str(self.log_ch_id) if self.log_ch_id else None
+            'g_id': self.g_id,  # must not be None
+            'incident_section_id': self.incident_section_id,
+            'stewards_id': self.stewards_id,
+            'statement_ch_id': self.statement_ch_id,
+            'log_ch_id': self.log_ch_id
+        })
+
+        return d
+
+
+class TranscriptMessage:
+    """normalized copy of a message in an incident channel
+       captured while the incident is open, the report is rendered from it
+    """
+
+    def __init__(self, json={}):
+
+        if not json:
+            json = {}
+
+        self.m_id = _get_int(json, 'm_id')
+        self.channel_id = _get_int(json, 'channel_id')
+
+        self.author_id = _get_int(json, 'author_id')
+        self.author_name = json.get('author_name', '')
+        self.author_avatar = json.get('author_avatar', None)
+        self.author_roles = list(map(int, json.get('author_roles', [])))
+
+        self.created_at = json.get('created_at', None)
+        self.edited_at = json.get('edited_at', None)
+        self.content = json.get('content', '')
+
+        # [{'type', 'title', 'description', 'fields': [{'name', 'value'}]}]
+        self.embeds = json.get('embeds', [])
+
+        # [{'filename', 'url'}]
+        self.attachments = json.get('attachments', [])
+
+    @staticmethod
+    def from_message(message):
+        """capture a discord message"""
+
+        def _str(val):
+            # discord.Embed.Empty is not serializable
+            return val if isinstance(val, str) else None
+
+        embeds = [{
+            'type': e.type,
+            'title': _str(e.title),
+            'description': _str(e.description),
+            'fields': [{'name': f.name, 'value': f.value} for f in e.fields]
+        } for e in message.embeds]
+
+        return TranscriptMessage({
+            'm_id': message.id,
+            'channel_id': message.channel.id,
+            'author_id': message.author.id,
+            'author_name': message.author.display_name,
+            'author_avatar': message.author.avatar,
+            # roles are only known for members, not for users who left the guild
+            'author_roles': [r.id for r in getattr(message.author, 'roles', [])],
+            'created_at': message.created_at,
+            'edited_at': message.edited_at,
+            'content': message.clean_content,
+            'embeds': embeds,
+            'attachments': [{'filename': a.filename, 'url': a.proxy_url} for a in message.attachments]
+        })
+
+    def _to_json(self):
+
+        d = dict({
+            'm_id': self.m_id,
+            'channel_id': self.channel_id,
+            'author_id': self.author_id,
+            'author_name': self.author_name,
+            'author_avatar': self.author_avatar,
+            'author_roles': self.author_roles,
+            'created_at': self.created_at,
+            'edited_at': self.edited_at,
+            'content': self.content,
+            'embeds': self.embeds,
+            'attachments': self.attachments
         })
 
         return d
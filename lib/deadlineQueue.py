@@ -0,0 +1,89 @@
+import heapq
+import asyncio
+
+from datetime import datetime
+
+
+class DeadlineQueue:
+    """priority queue of deadlines (naive utc datetimes)
+       wait_due() sleeps until the earliest deadline has expired
+
+       each key has at most one deadline, re-scheduling a key
+       leaves a stale heap entry behind which is skipped on pop
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        self._changed = asyncio.Event()
+
+
+    def __len__(self):
+        return len(self._deadlines)
+
+
+    def schedule(self, key, deadline: datetime):
+        """set the deadline of key, replaces the previous one
+           None removes the key from the queue
+        """
+
+        if deadline is None:
+            self.unschedule(key)
+            return
+
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+
+        # the new deadline could be earlier than the one wait_due() is sleeping for
+        self._changed.set()
+
+
+    def unschedule(self, key):
+        """NOP if key is not scheduled"""
+        self._deadlines.pop(key, None)
+
+
+    def is_scheduled(self, key):
+        return key in self._deadlines
+
+
+    def _discard_stale(self):
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+
+    async def wait_due(self):
+        """wait until at least one deadline expired
+
+           Returns: keys of all expired deadlines,
+                    they are removed from the queue
+        """
+
+        while True:
+            self._discard_stale()
+            self._changed.clear()
+
+            timeout = None
+            if self._heap:
+                timeout = (self._heap[0][0] - datetime.utcnow()).total_seconds()
+
+                if timeout <= 0:
+                    break
+
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        now = datetime.utcnow()
+        due = []
+
+        while self._heap and self._heap[0][0] <= now:
+            deadline, key = heapq.heappop(self._heap)
+
+            # skip stale entries of re-scheduled keys
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+                due.append(key)
+
+        return due
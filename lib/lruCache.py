@@ -0,0 +1,68 @@
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """bounded key-value store, evicts the least recently used entry
+       once max_size is exceeded
+
+       entries expire ttl seconds after put(), if ttl is given
+
+       counts hits and misses of get()
+    """
+
+    def __init__(self, max_size: int, ttl: float = None):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self._data = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def get(self, key, default=None):
+        """return the cached value of key
+           default, if key is not cached
+        """
+
+        if key not in self._data:
+            self.misses += 1
+            return default
+
+        value, expires = self._data[key]
+
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+
+        return value
+
+
+    def put(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+
+    def invalidate(self, key):
+        """remove key from the cache
+           NOP if key is not cached
+        """
+        self._data.pop(key, None)
+
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,141 @@
+import os
+import re
+import asyncio
+import sqlite3
+
+from datetime import datetime
+
+import lib.data
+
+
+# kept outside of the archive directory, it must not be served by the file server
+search_db_path = os.getenv('INCIDENT_SEARCH_DB', 'data/incident_search.db')
+
+
+class TranscriptCollector:
+    """exporter of write_html_report
+       collects the searchable text of all messages
+    """
+
+    def __init__(self):
+        self.parts = []
+
+
+    def add_message(self, msg, author_role: str, attachment_hashes: []):
+        self.parts.append(msg.content)
+
+        for embed in msg.embeds:
+            self.parts.extend(filter(None, [embed['title'], embed['description']]))
+            self.parts.extend(f'{field["name"]}: {field["value"]}' for field in embed['fields'])
+
+
+    def get_text(self):
+        return '\n'.join(self.parts)
+
+
+class SearchIndex:
+    """full-text index of closed incidents, stored in a local sqlite fts5 table
+       the blocking sqlite calls are run in the default executor
+    """
+
+    page_size = 5
+
+    # columns of the fts5 table, the rowid is the channel id of the incident
+    # g_id and metadata are stored, but not tokenized
+    _schema = 'CREATE VIRTUAL TABLE IF NOT EXISTS incidents USING fts5('\
+              'g_id UNINDEXED, ticket UNINDEXED, closed UNINDEXED, '\
+              'race_name, drivers, infringement, outcome, transcript)'
+
+    _initialized = False
+
+
+    @staticmethod
+    def _connect():
+        db_dir = os.path.dirname(search_db_path)
+
+        if not SearchIndex._initialized and db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        con = sqlite3.connect(search_db_path)
+        con.row_factory = sqlite3.Row
+
+        if not SearchIndex._initialized:
+            con.execute(SearchIndex._schema)
+            SearchIndex._initialized = True
+
+        return con
+
+
+    @staticmethod
+    def _to_match_query(query: str):
+        """convert user input into a fts5 query
+           every whitespace separated term is matched as phrase, all terms must match
+           e.g. '#44 T1 dive-bomb' -> '"44" "T1" "dive bomb"'
+
+           None, if the query doesn't contain any word
+        """
+
+        phrases = []
+
+        for term in query.split():
+            words = re.findall(r'\w+', term)
+            if words:
+                phrases.append('"{:s}"'.format(' '.join(words)))
+
+        return ' '.join(phrases) if phrases else None
+
+
+    @staticmethod
+    def _add_incident(incident: lib.data.Incident, ticket: str, transcript: str):
+        drivers = '{} #{} {} #{}'.format(incident.victim.name, incident.victim.number,
+                                         incident.offender.name, incident.offender.number)
+
+        con = SearchIndex._connect()
+        try:
+            with con:
+                # re-closing a ticket replaces the previous entry
+                con.execute('DELETE FROM incidents WHERE rowid = ?', (incident.channel_id,))
+                con.execute('INSERT INTO incidents(rowid, g_id, ticket, closed, race_name, drivers, infringement, outcome, transcript) '\
+                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (incident.channel_id, incident.g_id, ticket, datetime.utcnow().strftime('%d.%m.%y'),
+                             incident.race_name, drivers, incident.infringement, incident.outcome, transcript))
+        finally:
+            con.close()
+
+
+    @staticmethod
+    def _search(guild_id: int, query: str, page: int):
+        match = SearchIndex._to_match_query(query)
+
+        if not match:
+            return [], 0
+
+        con = SearchIndex._connect()
+        try:
+            total = con.execute('SELECT count(*) FROM incidents WHERE incidents MATCH ? AND g_id = ?', (match, guild_id)).fetchone()[0]
+
+            rows = con.execute('SELECT ticket, closed, race_name, drivers, snippet(incidents, -1, \'**\', \'**\', \'...\', 12) AS snippet '\
+                               'FROM incidents WHERE incidents MATCH ? AND g_id = ? ORDER BY rank LIMIT ? OFFSET ?',
+                               (match, guild_id, SearchIndex.page_size, (page - 1) * SearchIndex.page_size)).fetchall()
+        finally:
+            con.close()
+
+        return [dict(row) for row in rows], total
+
+
+    @staticmethod
+    async def add_incident(incident: lib.data.Incident, ticket: str, transcript: str):
+        """add the closed incident to the index
+           replaces the previous entry of the same incident
+        """
+        await asyncio.get_event_loop().run_in_executor(None, SearchIndex._add_incident, incident, ticket, transcript)
+
+
+    @staticmethod
+    async def search(guild_id: int, query: str, page: int = 1):
+        """search all closed incidents of the guild, best matches first
+
+        Returns:
+            ([dict], int): hits of the page (ticket, closed, race_name, drivers, snippet), total number of hits
+        """
+        return await asyncio.get_event_loop().run_in_executor(None, SearchIndex._search, guild_id, query, page)
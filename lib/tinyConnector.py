@@ -1,11 +1,26 @@
 import os
+import asyncio
 import pymongo
-from pymongo import MongoClient
+from pymongo import UpdateOne, DeleteMany, ReturnDocument
+from motor.motor_asyncio import AsyncIOMotorClient
 
 from datetime import datetime
 import json
 
 import lib.data
+from lib.lruCache import LRUCache
+from lib.deadlineQueue import DeadlineQueue
+
+
+class IncidentConflictError(Exception):
+    """the incident was modified (or deleted) since it was loaded
+       the operation can be retried after re-loading the incident
+    """
+
+    def __init__(self, channel_id: int):
+        super().__init__(f'incident {channel_id} was modified concurrently')
+        self.channel_id = channel_id
+
 
 class Server:
     g_id = None  # id
@@ -24,33 +39,224 @@ class TinyConnector:
     client = None
     db = None
 
+    # channel ids of all open incidents
+    # lets on_message skip the db for all non-incident channels
+    active_channels = set()
+
+    # buffered last_msg timestamps, keyed by channel id
+    pending_msg_ts = {}
+
+    # raw settings documents, keyed by guild id
+    settings_cache = LRUCache(1024)
+
+    # bumped on every settings write, keyed by guild id
+    # a read which overlapped with a write must not fill the cache
+    settings_generation = {}
+
+    # next_deadline of all open incidents, keyed by channel id
+    deadlines = DeadlineQueue()
+
+    # buffered transcript writes, in order of arrival
+    pending_transcript_ops = []
+
+    # a flush must wait for the bulk_write of a running one (see delete_incident)
+    transcript_flush_lock = asyncio.Lock()
+
+    # required indexes per collection, as (field, unique)
+    # a tuple of fields creates a compound index
+    indexes = {
+        'incidents': [('channel_id', True), ('next_deadline', False)],
+        'settings': [('g_id', True)],
+        'incident_cnt': [('g_id', True)],
+        'transcripts': [('m_id', True), (('channel_id', 'm_id'), False)]
+    }
+
     @staticmethod
-    def init():
+    async def init():
+        """connect to the db, migrate the schema, create the indexes
+           and load the active incident channels and their deadlines
+        """
         host = os.getenv('MONGO_CONN')
         port = int(os.getenv('MONGO_PORT'))
 
         uname = os.getenv('MONGO_ROOT_USER')
         pw = os.getenv('MONGO_ROOT_PASS')
 
-        TinyConnector.client = MongoClient(host=host, username=uname, password=pw, port=port)
+        TinyConnector.client = AsyncIOMotorClient(host=host, username=uname, password=pw, port=port)
         TinyConnector.db = TinyConnector.client.incidentBot
 
+        # migrations first, unique indexes cannot be build on duplicate documents
+        await TinyConnector._migrate_schema()
+        await TinyConnector._create_indexes()
+
+        async for inc_json in TinyConnector.db.incidents.find({}, {'channel_id': 1, 'next_deadline': 1}):
+            channel_id = int(inc_json['channel_id'])
+
+            TinyConnector.active_channels.add(channel_id)
+            TinyConnector.deadlines.schedule(channel_id, inc_json.get('next_deadline', None))
+
+
+    @staticmethod
+    async def _create_indexes():
+        """create all required indexes (NOP if existing)
+           and verify them afterwards
+
+           raises RuntimeError if an index is missing or not unique
+        """
+
+        for coll_name, indexes in TinyConnector.indexes.items():
+            collection = TinyConnector.db[coll_name]
+
+            for field, unique in indexes:
+                await collection.create_index(TinyConnector._index_key(field), unique=unique)
+
+            info = await collection.index_information()
+            existing = {tuple(idx['key']): idx.get('unique', False) for idx in info.values()}
+
+            for field, unique in indexes:
+                key = tuple(TinyConnector._index_key(field))
+
+                if key not in existing:
+                    raise RuntimeError(f'index on {coll_name}.{field} is missing')
+                if unique and not existing[key]:
+                    raise RuntimeError(f'index on {coll_name}.{field} is not unique')
+
+
+    @staticmethod
+    def _index_key(field):
+        fields = field if isinstance(field, tuple) else (field,)
+        return [(f, pymongo.ASCENDING) for f in fields]
+
+
+    @staticmethod
+    async def _migrate_schema():
+        """run all migrations newer than the stored schema version
+           the version is increased after each successful migration
+        """
+
+        # the list index + 1 is the schema version after the migration
+        migrations = [
+            TinyConnector._migrate_remove_duplicates,
+            TinyConnector._migrate_int64_ids,
+            TinyConnector._migrate_version_field,
+            TinyConnector._migrate_next_deadline
+        ]
+
+        version_doc = await TinyConnector.db.schema.find_one({'_id': 'version'})
+        version = version_doc['version'] if version_doc else 0
+
+        for i, migration in enumerate(migrations[version:], start=version+1):
+            print(f'migrating db schema to version {i}')
+            await migration()
+            await TinyConnector.db.schema.replace_one({'_id': 'version'}, {'_id': 'version', 'version': i}, upsert=True)
+
+
+    @staticmethod
+    async def _remove_duplicates(collection, field, sort=None):
+        """delete all documents sharing the same field value,
+           except the first one (in order of sort)
+        """
+
+        pipeline = [{'$sort': sort}] if sort else []
+        pipeline += [
+            {'$group': {'_id': f'${field}', 'ids': {'$push': '$_id'}, 'cnt': {'$sum': 1}}},
+            {'$match': {'cnt': {'$gt': 1}}}
+        ]
+
+        async for group in collection.aggregate(pipeline):
+            await collection.delete_many({'_id': {'$in': group['ids'][1:]}})
+
+
+    @staticmethod
+    async def _migrate_remove_duplicates():
+        # upserts without unique index could create duplicates on concurrent access
+        await TinyConnector._remove_duplicates(TinyConnector.db.incidents, 'channel_id')
+        await TinyConnector._remove_duplicates(TinyConnector.db.settings, 'g_id')
+
+        # keep the highest counter, to never re-use a ticket number
+        await TinyConnector._remove_duplicates(TinyConnector.db.incident_cnt, 'g_id', sort={'incident_cnt': -1})
+
+
+    @staticmethod
+    async def _migrate_int64_ids():
+        # ids were stored as decimal strings, convert them in-place to int64
+        # $toLong keeps existing int64 and null values as they are
+        # update_many with an aggregation pipeline requires MongoDB 4.2 or newer
+        server_info = await TinyConnector.client.server_info()
+        if tuple(server_info['versionArray'][:2]) < (4, 2):
+            raise RuntimeError(f'MongoDB {server_info["version"]} is not supported, the schema migration requires 4.2 or newer')
+
+        await TinyConnector.db.incidents.update_many({}, [{'$set': {
+            'g_id': {'$toLong': '$g_id'},
+            'channel_id': {'$toLong': '$channel_id'},
+            'victim.u_id': {'$toLong': '$victim.u_id'},
+            'offender.u_id': {'$toLong': '$offender.u_id'},
+            'cleanup_queue': {'$map': {'input': {'$ifNull': ['$cleanup_queue', []]}, 'in': {'$toLong': '$$this'}}}
+        }}])
+
+        await TinyConnector.db.settings.update_many({}, [{'$set': {
+            'g_id': {'$toLong': '$g_id'},
+            'incident_section_id': {'$toLong': '$incident_section_id'},
+            'stewards_id': {'$toLong': '$stewards_id'},
+            'statement_ch_id': {'$toLong': '$statement_ch_id'},
+            'log_ch_id': {'$toLong': '$log_ch_id'}
+        }}])
+
+        await TinyConnector.db.incident_cnt.update_many({}, [{'$set': {'g_id': {'$toLong': '$g_id'}}}])
+
+
+    @staticmethod
+    async def _migrate_version_field():
+        await TinyConnector.db.incidents.update_many({'version': {'$exists': False}}, {'$set': {'version': 0}})
+
+
+    @staticmethod
+    async def _migrate_next_deadline():
+        async for inc_json in TinyConnector.db.incidents.find({'next_deadline': {'$exists': False}}):
+            deadline = lib.data.Incident(inc_json).get_deadline()
+            await TinyConnector.db.incidents.update_one({'_id': inc_json['_id']}, {'$set': {'next_deadline': deadline}})
+
+
+    @staticmethod
+    def is_incident_channel(channel_id: int):
+        """true, if the channel belongs to an open incident
+           does not access the db
+        """
+        return channel_id in TinyConnector.active_channels
+
+
+    @staticmethod
+    async def _delete_guild(guild_id: int):
+        await TinyConnector.db.settings.delete_one({'g_id': guild_id})
+        await TinyConnector.db.incident_cnt.delete_one({'g_id': guild_id})
+
+        TinyConnector._invalidate_settings(guild_id)
+
 
     @staticmethod
-    def _delete_guild(guild_id: int):
-        TinyConnector.db.settings.delete_one({'g_id': str(guild_id)})
-        TinyConnector.db.incident_cnt.delete_one({'g_id': str(guild_id)})
+    def _invalidate_settings(guild_id: int):
+        TinyConnector.settings_generation[guild_id] = TinyConnector.settings_generation.get(guild_id, 0) + 1
+        TinyConnector.settings_cache.invalidate(guild_id)
 
 
     # get the server object from db, creates new entry if not exists yet
     # guaranteed to return a object
     @staticmethod
-    def get_settings(guild_id: int):
+    async def get_settings(guild_id: int):
+
+        # the cache holds the raw document, every caller gets its own object
+        sett_json = TinyConnector.settings_cache.get(guild_id)
+
+        if sett_json is None:
+            generation = TinyConnector.settings_generation.get(guild_id, 0)
+            sett_json = await TinyConnector.db.settings.find_one({'g_id': guild_id})
 
-        sett_json = TinyConnector.db.settings.find_one({'g_id': str(guild_id)})
+            if not sett_json:
+                sett_json = {'g_id': guild_id}
 
-        if not sett_json:
-            return lib.data.Settings({'g_id': guild_id})
+            # the document might be outdated already, if the settings were written meanwhile
+            if generation == TinyConnector.settings_generation.get(guild_id, 0):
+                TinyConnector.settings_cache.put(guild_id, sett_json)
 
         return lib.data.Settings(sett_json)
 
@@ -58,112 +264,223 @@ class TinyConnector:
     # save changes to a server into the db
     # never use self-contsructed Server objects
     @staticmethod
-    def update_settings(settings: lib.data.Settings):
+    async def update_settings(settings: lib.data.Settings):
         """update the entire guild object in the db
            might cause data loss, if multiple guild objects are accessed async
 
         """
         sett_json = settings._to_json()
-        TinyConnector.db.settings.replace_one({'g_id': str(settings.g_id)}, sett_json, upsert=True)
+        await TinyConnector.db.settings.replace_one({'g_id': settings.g_id}, sett_json, upsert=True)
+
+        TinyConnector._invalidate_settings(settings.g_id)
+
+
+    @staticmethod
+    def get_settings_cache_stats():
+        """hit/miss counters of the settings cache"""
+        return TinyConnector.settings_cache.stats()
 
 
     @staticmethod
-    def update_incident(incident: lib.data.Incident):
+    async def update_incident(incident: lib.data.Incident):
         """update only the passed incident in the db
-           all other modifications to the guild obj are lost
-           prevents data loss, as long as each incident is only accessed at a time
-           (but multiple guild objects at a time)
+           new incidents are inserted as a whole,
+           loaded incidents only $set the fields modified since loading
 
-           get_guild MUST be called before
+           in-place modifications of the cleanup queue are not written,
+           use extend_cleanup_queue/clear_cleanup_queue instead
 
+           raises IncidentConflictError if the incident was updated
+           by someone else since it was loaded
         """
 
-        inc_json = incident._to_json()
-        TinyConnector.db.incidents.replace_one({'channel_id': str(incident.channel_id)}, inc_json, upsert=True)
+        # the deadline might be an outdated lower bound,
+        # as buffered message timestamps are not considered
+        deadline = incident._update_deadline(datetime.utcnow())
+
+        if not incident._persisted:
+            inc_json = incident._to_json()
+            await TinyConnector.db.incidents.replace_one({'channel_id': incident.channel_id}, inc_json, upsert=True)
+            incident._persisted = True
+        else:
+            changes = incident._get_changes()
+            changes.pop('version', None)  # only ever changed by $inc
+
+            if changes:
+                # compare-and-swap, only succeeds if nobody else updated the incident meanwhile
+                result = await TinyConnector.db.incidents.update_one({'channel_id': incident.channel_id, 'version': incident.version},
+                                                                     {'$set': changes, '$inc': {'version': 1}})
+
+                if result.matched_count == 0:
+                    raise IncidentConflictError(incident.channel_id)
+
+                incident.version += 1
+
+        incident._clear_changes()
+        TinyConnector.active_channels.add(incident.channel_id)
+        TinyConnector.deadlines.schedule(incident.channel_id, deadline)
 
 
     @staticmethod
     def update_incident_msg_ts(channel_id: int):
-        """update the last_msg property of the current incident
-           to the current utc timestamp
+        """buffer the current utc timestamp as last_msg property of the incident
+           the buffer is written by flush_incident_msg_ts
 
            Returns: true on success, false if incident is not existing
         """
 
-        ts = datetime.utcnow()
+        # most messages are not send into incident channels
+        if not TinyConnector.is_incident_channel(channel_id):
+            return False
 
-        result = TinyConnector.db.incidents.find_one_and_update({'channel_id': str(channel_id)}, {'$set': {'last_msg': ts}})
+        # only the latest timestamp per channel is kept
+        TinyConnector.pending_msg_ts[channel_id] = datetime.utcnow()
 
-        return result != None
+        return True
 
 
     @staticmethod
-    def get_incident(channel_id: int):
-        """return the incident of the given channel
-           None, if no incident is open
+    async def flush_incident_msg_ts():
+        """write all buffered last_msg timestamps
+           with a single bulk_write
         """
-        inc_json = TinyConnector.db.incidents.find_one({'channel_id': str(channel_id)})
 
-        if not inc_json:
-            return None
+        if not TinyConnector.pending_msg_ts:
+            return
 
-        return lib.data.Incident(inc_json)
+        pending = TinyConnector.pending_msg_ts
+        TinyConnector.pending_msg_ts = {}
+
+        # $max, a state change (see update_incident) might have set a newer timestamp meanwhile
+        ops = [UpdateOne({'channel_id': channel_id}, {'$max': {'last_msg': ts}}) for channel_id, ts in pending.items()]
+
+        try:
+            await TinyConnector.db.incidents.bulk_write(ops, ordered=False)
+        except:
+            # re-queue the failed timestamps, unless a newer one arrived meanwhile
+            for channel_id, ts in pending.items():
+                TinyConnector.pending_msg_ts.setdefault(channel_id, ts)
+            raise
 
 
     @staticmethod
-    def extend_cleanup_queue(channel_id, message_ids: []):
-        """add a range of message ids to the cleanup queue
-           NOP if incident does not exist
+    def put_transcript_message(message: lib.data.TranscriptMessage):
+        """buffer a new or edited message of an incident channel
+           the buffer is written by flush_transcript
         """
 
-        m_ids = list(map(str, message_ids))
+        # the incident might have been deleted while the message was fetched
+        if not TinyConnector.is_incident_channel(message.channel_id):
+            return
 
-        TinyConnector.db.incidents.find_one_and_update({'channel_id': str(channel_id)}, {'$push': {'cleanup_queue': {'$each': m_ids}}})
+        # replaces the previous version of an edited message
+        op = UpdateOne({'m_id': message.m_id}, {'$set': message._to_json()}, upsert=True)
+        TinyConnector.pending_transcript_ops.append(op)
 
 
     @staticmethod
-    def clear_cleanup_queue(channel_id: int):
-        """resets the cleanup queue of the specified incident
-           NOP if incident not existing
+    def delete_transcript_messages(message_ids: []):
+        """buffer the removal of deleted messages from the transcript"""
+
+        op = DeleteMany({'m_id': {'$in': list(map(int, message_ids))}})
+        TinyConnector.pending_transcript_ops.append(op)
+
+
+    @staticmethod
+    async def flush_transcript():
+        """write all buffered transcript changes
+           with a single ordered bulk_write
         """
 
-        TinyConnector.db.incidents.find_one_and_update({'channel_id': str(channel_id)}, {'$set': {'cleanup_queue': []}})
+        async with TinyConnector.transcript_flush_lock:
+            if not TinyConnector.pending_transcript_ops:
+                return
+
+            pending = TinyConnector.pending_transcript_ops
+            TinyConnector.pending_transcript_ops = []
+
+            try:
+                await TinyConnector.db.transcripts.bulk_write(pending, ordered=True)
+            except:
+                # re-queue in front of the newer changes, all operations are idempotent
+                TinyConnector.pending_transcript_ops = pending + TinyConnector.pending_transcript_ops
+                raise
 
 
     @staticmethod
-    def get_incident_modified_before(timestamp):
-        """get all incident with the last modification
-           older than the supplied timestamp
+    async def get_transcript(channel_id: int):
+        """async generator of all captured messages of the channel
+           in chronological order, flush_transcript must be called before
         """
 
-        incs =  list(TinyConnector.db.incidents.find({'last_msg': {'$lt': timestamp}}))
-        incs = list(map(lib.data.Incident, incs))
+        async for msg_json in TinyConnector.db.transcripts.find({'channel_id': channel_id}).sort('m_id', pymongo.ASCENDING):
+            yield lib.data.TranscriptMessage(msg_json)
 
-        return incs
 
     @staticmethod
-    def get_incident_locked_before(timestamp):
-        """get all incidents which have been locked
-           before the given timestmap
+    async def get_last_transcript_m_id(channel_id: int):
+        """id of the newest captured message of the channel
+           None, if no message was captured yet
         """
 
-        incs =  list(TinyConnector.db.incidents.find({'locked_time': {'$lt': timestamp}}))
-        incs = list(map(lib.data.Incident, incs))
+        msg_json = await TinyConnector.db.transcripts.find_one({'channel_id': channel_id}, {'m_id': 1}, sort=[('m_id', pymongo.DESCENDING)])
+        return int(msg_json['m_id']) if msg_json else None
 
-        return incs
 
     @staticmethod
-    def delete_incident(channel_id: int):
+    async def get_incident(channel_id: int):
+        """return the incident of the given channel
+           None, if no incident is open
+        """
+        inc_json = await TinyConnector.db.incidents.find_one({'channel_id': channel_id})
+
+        if not inc_json:
+            return None
+
+        return lib.data.Incident(inc_json)
+
+
+    @staticmethod
+    async def extend_cleanup_queue(channel_id, message_ids: []):
+        """add a range of message ids to the cleanup queue
+           NOP if incident does not exist
+        """
+
+        m_ids = list(map(int, message_ids))
+
+        await TinyConnector.db.incidents.find_one_and_update({'channel_id': channel_id}, {'$push': {'cleanup_queue': {'$each': m_ids}}})
+
+
+    @staticmethod
+    async def clear_cleanup_queue(channel_id: int):
+        """resets the cleanup queue of the specified incident
+           NOP if incident not existing
+        """
+
+        await TinyConnector.db.incidents.find_one_and_update({'channel_id': channel_id}, {'$set': {'cleanup_queue': []}})
+
+
+    @staticmethod
+    async def delete_incident(channel_id: int):
         """deletes given incident out of db
            get_guild MUST be called before
 
         """
-        TinyConnector.db.incidents.delete_one({'channel_id': str(channel_id)})
+        # first, events arriving during the awaits below must not buffer new transcript writes
+        TinyConnector.active_channels.discard(channel_id)
+        TinyConnector.deadlines.unschedule(channel_id)
+        TinyConnector.pending_msg_ts.pop(channel_id, None)
+
+        await TinyConnector.db.incidents.delete_one({'channel_id': channel_id})
+
+        # buffered and in-flight writes would re-create the deleted messages otherwise
+        await TinyConnector.flush_transcript()
+        await TinyConnector.db.transcripts.delete_many({'channel_id': channel_id})
 
     @staticmethod
-    def get_inc_cnt(guild_id: int):
+    async def get_inc_cnt(guild_id: int):
 
-        result = TinyConnector.db.incident_cnt.find_one({'g_id': str(guild_id)}, {'incident_cnt': 1})
+        result = await TinyConnector.db.incident_cnt.find_one({'g_id': guild_id}, {'incident_cnt': 1})
 
         if not result:
             return 0
@@ -172,6 +489,18 @@ class TinyConnector:
 
 
     @staticmethod
-    def incr_inc_cnt(guild_id: int):
+    async def allocate_inc_cnt(guild_id: int):
+        """atomically increment the incident counter of the guild
+           returns the new value, which is unique per guild
+        """
+
+        try:
+            result = await TinyConnector.db.incident_cnt.find_one_and_update({'g_id': guild_id}, {'$inc': {'incident_cnt': 1}},
+                                                                             upsert=True, return_document=ReturnDocument.AFTER)
+        except pymongo.errors.DuplicateKeyError:
+            # concurrent first allocations of a guild race on the upsert (mongodb < 4.2 doesn't retry them)
+            # the counter exists now, the retry is a plain increment
+            result = await TinyConnector.db.incident_cnt.find_one_and_update({'g_id': guild_id}, {'$inc': {'incident_cnt': 1}},
+                                                                             return_document=ReturnDocument.AFTER)
 
-        TinyConnector.db.incident_cnt.find_one_and_update({'g_id': str(guild_id)}, {'$inc': {'incident_cnt': 1}}, new=True, upsert=True)
+        return result['incident_cnt']
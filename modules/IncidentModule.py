@@ -1,6 +1,12 @@
 import os
 import re
 import io
+import gzip
+import time
+import copy
+import asyncio
+import contextlib
+import weakref
 import requests
 
 from datetime import datetime, timedelta
@@ -12,8 +18,9 @@ from discord_slash.utils import manage_components
 from discord_slash.model import SlashCommandOptionType, ButtonStyle
 from discord_slash.utils.manage_commands import create_option, create_choice
 
-from lib.tinyConnector import TinyConnector
-from lib.data import Incident, Driver, State
+from lib.tinyConnector import TinyConnector, IncidentConflictError
+from lib.data import Incident, Driver, State, TranscriptMessage
+from lib.searchIndex import SearchIndex, TranscriptCollector
 
 from consts import Consts
 
@@ -22,7 +29,13 @@ from util.verboseErrors import VerboseErrors
 from util.interaction import ack_message, guess_target_section, guess_target_text, get_client_response, get_client_reaction, wait_confirm_deny
 
 from util.displayEmbeds import incident_embed
-from util.htm_gen import gen_html_report
+from util.memberResolver import MemberResolver
+from util.renameQueue import RenameQueue
+from util.htm_gen import write_html_report
+from util.attachmentDownloader import AttachmentDownloader
+from util.blobStore import BlobStore
+from util.imageCompressor import ImageCompressor
+from util.ndjsonExport import NdjsonExporter
 
 
 fileserver_whitelist = [140150091607441408, 722746405453692989]
@@ -32,11 +45,40 @@ passcode_port = os.getenv("FS_PASSCODE_PORT")
 archive_secret = os.getenv("FS_SECRET")
 passcode_host = os.getenv("ARCHIVE_CONTAINER")
 
+# delay before re-trying an incident whose timeout did not advance the state
+timeout_retry_delay = timedelta(minutes=5)
+
+# fields of a message update, which contains the complete message
+message_update_fields = ('id', 'author', 'content', 'embeds', 'attachments', 'type', 'pinned', 'tts', 'mention_everyone')
+
+# max. number of due incidents processed at the same time (across all guilds)
+timeout_concurrency = int(os.getenv('INCIDENT_TIMEOUT_CONCURRENCY', '8'))
+
 # print(f'arch_directory: {archive_directory}')
 # print(f'archive_secret: {archive_secret}')
 # print(f'passcode_port: {passcode_port}')
 # print(f'passcode_host: {passcode_host}')
 
+class ChannelActivity:
+    """messages of an incident channel since the last message of the bot
+       maintained by on_message, replaces scanning the channel history
+    """
+
+    def __init__(self):
+        self.authors = set()  # all authors since the last bot prompt
+
+        # False until a bot message was observed
+        # before that, messages prior to the tracking (e.g. a restart) might be missing
+        self.synced = False
+
+    def add_message(self, message, bot_id):
+        if message.author.id == bot_id:
+            self.authors.clear()
+            self.synced = True
+        else:
+            self.authors.add(message.author.id)
+
+
 class IncidentModule(commands.Cog):
 
     # =====================
@@ -44,25 +86,136 @@ class IncidentModule(commands.Cog):
     # =====================
     def __init__(self, client):
         self.client = client
+
+        self.timeout_semaphore = asyncio.Semaphore(timeout_concurrency)
+        self.timeout_guild_locks = weakref.WeakValueDictionary()  # lock lives as long as a task holds it
+        self.background_tasks = set()
+        self.channel_activity = {}  # ChannelActivity per incident channel id
+        self.rename_queue = RenameQueue()
+        self.downloader = AttachmentDownloader()
+        self.image_compressor = ImageCompressor()
+
         self.incident_timeout.start()
+        self.flush_msg_ts.start()
+
+
+    def cog_unload(self):
+        self.incident_timeout.cancel()
+        self.flush_msg_ts.cancel()  # flushes the pending timestamps in after_loop
+
+        for task in self.background_tasks:
+            task.cancel()
+
+        self.rename_queue.cancel_all()
+        asyncio.ensure_future(self.downloader.close())
+        self.image_compressor.close()
 
 
     def _is_member_steward(self, member, steward_id):
             return any(r.id == steward_id for r in member.roles)
 
 
+    async def _get_transcript(self, channel, incident):
+        """all messages of the incident channel as TranscriptMessage, oldest first"""
+
+        if incident.transcript:
+            await TinyConnector.flush_transcript()
+
+            async for msg in TinyConnector.get_transcript(channel.id):
+                yield msg
+        else:
+            # the incident was opened before messages were captured, backfill from the channel history
+            # fetched lazily page by page (100 messages per request), discord.py waits on rate limits
+            async for msg in channel.history(limit=None, oldest_first=True):
+                yield TranscriptMessage.from_message(msg)
+
+
+    async def _backfill_transcript(self, channel):
+        """capture the messages the gateway events missed (e.g. while the bot was offline)
+           only messages newer than the last captured one are fetched,
+           edits and deletions of older messages are not reconciled
+        """
+
+        await TinyConnector.flush_transcript()
+        last_m_id = await TinyConnector.get_last_transcript_m_id(channel.id)
+
+        after = discord.Object(id=last_m_id) if last_m_id else None
+        async for msg in channel.history(limit=None, after=after, oldest_first=True):
+            TinyConnector.put_transcript_message(TranscriptMessage.from_message(msg))
+
+        await TinyConnector.flush_transcript()
+
+
+    async def _backfill_open_transcripts(self):
+        for channel_id in list(TinyConnector.active_channels):
+            try:
+                incident = await TinyConnector.get_incident(channel_id)
+                channel = self.client.get_channel(channel_id)
+
+                if incident and incident.transcript and incident.state != State.CLOSED_PHASE and channel:
+                    await self._backfill_transcript(channel)
+            except Exception as e:
+                print(f'failed to backfill the transcript of incident {channel_id}:')
+                print(e)
+
+
+    def _run_in_background(self, coro):
+        # keep a reference, otherwise the task could be garbage collected before completion
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+
+    async def _del_msg(self, channel, m_id):
+        try:
+            await channel.get_partial_message(m_id).delete()
+        except discord.errors.NotFound:
+            # ignore if msg is not existing
+            pass
+        except discord.errors.HTTPException as e:
+            print(f'failed to delete message {m_id}:')
+            print(e)
+
+
     async def _del_msg_list(self, channel, msg_ids: []):
-        for m_id in msg_ids:
+        # the bulk endpoint is limited to 100 messages younger than 14 days
+        # unknown message ids are ignored by discord, no need to fetch them first
+        bulk_limit = datetime.utcnow() - timedelta(days=14) + timedelta(minutes=5)
+
+        recent = [m_id for m_id in msg_ids if discord.utils.snowflake_time(m_id) > bulk_limit]
+        old = [m_id for m_id in msg_ids if discord.utils.snowflake_time(m_id) <= bulk_limit]
+
+        for i in range(0, len(recent), 100):
+            chunk = recent[i:i+100]
+
             try:
-                msg = await channel.fetch_message(m_id)
-                await msg.delete()
-            except:
-                # ignore if msg is not existing
-                pass
+                await channel.delete_messages([discord.Object(id=m_id) for m_id in chunk])
+            except discord.errors.HTTPException:
+                # fall back to single deletion, e.g. if a message is exactly at the age limit
+                old.extend(chunk)
+
+        for m_id in old:
+            await self._del_msg(channel, m_id)
+
+
+    def _cleanup_msg_list(self, channel, msg_ids: []):
+        """delete the messages in the background,
+           the state transition doesn't wait for the cleanup
+        """
+        self._run_in_background(self._del_msg_list(channel, list(msg_ids)))
 
 
     async def _test_msg_was_send(self, channel, tgt_author_id, bot_id):
 
+        activity = self.channel_activity.get(channel.id, None)
+
+        if activity:
+            if tgt_author_id in activity.authors:
+                return True
+            elif activity.synced:
+                return False
+
+        # no complete record of the channel (e.g. after a restart), scan the history instead
         # this iterates in reverse
         # limit detection to last 5 messages (reducing latency cmp. to last 10 or 20)
         async for message in channel.history(limit=5):
@@ -121,8 +274,8 @@ class IncidentModule(commands.Cog):
 
     async def cancel(self, cmd):
 
-        server = TinyConnector.get_settings(cmd.guild.id)
-        incident = TinyConnector.get_incident(cmd.channel.id)
+        server = await TinyConnector.get_settings(cmd.guild.id)
+        incident = await TinyConnector.get_incident(cmd.channel.id)
 
 
         if not incident:
@@ -142,16 +295,19 @@ class IncidentModule(commands.Cog):
 
 
         # the stewards can always cancel a ticket
-
-        await cmd.send('This incident is now marked as closed. It will be deleted soon.')
         incident.state = State.CLOSED_PHASE
         incident.locked_time = datetime.utcnow()
 
-        # the incident channel is the command channel
-        await cmd.channel.edit(name= '❌ ' + cmd.channel.name[1:])
+        try:
+            await TinyConnector.update_incident(incident)
+        except IncidentConflictError:
+            await cmd.send('The ticket was modified at the same time, please try again')
+            return
 
+        await cmd.send('This incident is now marked as closed. It will be deleted soon.')
 
-        TinyConnector.update_incident(incident)
+        # the incident channel is the command channel
+        self.rename_queue.request(cmd.channel, '❌ ' + cmd.channel.name[1:])
 
 
 
@@ -160,23 +316,29 @@ class IncidentModule(commands.Cog):
     #################################################
 
 
+    async def _set_write_permissions(self, channel, victim, offender, victim_write, offender_write):
+        # replace both member overwrites with a single api call
+        # all other overwrites (bot, stewards, @everyone) are kept
+        overwrites = dict(channel.overwrites)
+        overwrites[victim] = discord.PermissionOverwrite(read_messages=True, send_messages=victim_write, read_message_history=True)
+        overwrites[offender] = discord.PermissionOverwrite(read_messages=True, send_messages=offender_write, read_message_history=True)
+
+        await channel.edit(overwrites=overwrites)
+
+
     async def _set_offender_write(self, channel, victim, offender):
-        await channel.set_permissions(victim, read_messages=True, send_messages=False, read_message_history=True)
-        await channel.set_permissions(offender, read_messages=True, send_messages=True, read_message_history=True)
+        await self._set_write_permissions(channel, victim, offender, victim_write=False, offender_write=True)
 
 
     async def _set_victim_write(self, channel, victim, offender):
-        await channel.set_permissions(victim, read_messages=True, send_messages=True, read_message_history=True)
-        await channel.set_permissions(offender, read_messages=True, send_messages=False, read_message_history=True)
+        await self._set_write_permissions(channel, victim, offender, victim_write=True, offender_write=False)
 
     async def _set_all_write(self, channel, victim, offender):
-        await channel.set_permissions(victim, read_messages=True, send_messages=True, read_message_history=True)
-        await channel.set_permissions(offender, read_messages=True, send_messages=True, read_message_history=True)
+        await self._set_write_permissions(channel, victim, offender, victim_write=True, offender_write=True)
 
 
     async def _set_no_write(self, channel, victim, offender):
-        await channel.set_permissions(victim, read_messages=True, send_messages=False, read_message_history=True)
-        await channel.set_permissions(offender, read_messages=True, send_messages=False, read_message_history=True)
+        await self._set_write_permissions(channel, victim, offender, victim_write=False, offender_write=False)
 
 
 
@@ -184,13 +346,16 @@ class IncidentModule(commands.Cog):
     ##  Incident Messages - send user messages
     #################################################
 
-    async def incident_victim_proof(self, guild, channel_id, incident_id):
+    # the incident passed to the state transitions is the object the current state was checked on
+    # it must not be re-fetched: the update fails with IncidentConflictError if the ticket
+    # was advanced meanwhile (e.g. double click or timeout), before any message is sent
+
+    async def incident_victim_proof(self, guild, channel_id, incident: Incident):
 
-        server = TinyConnector.get_settings(guild.id)
-        incident = TinyConnector.get_incident(incident_id)
+        server = await TinyConnector.get_settings(guild.id)
 
         incident.state  = State.VICTIM_PROOF
-        TinyConnector.update_incident(incident)
+        await TinyConnector.update_incident(incident)
 
 
         # incident id is channel id
@@ -198,8 +363,8 @@ class IncidentModule(commands.Cog):
 
 
         # delete the old questions, this helps in keeping the channel clean
-        await self._del_msg_list(channel, incident.cleanup_queue)
-        TinyConnector.clear_cleanup_queue(channel_id)
+        self._cleanup_msg_list(channel, incident.cleanup_queue)
+        await TinyConnector.clear_cleanup_queue(channel_id)
 
         comps = self._component_factory(allow_revert=True)
 
@@ -214,17 +379,16 @@ class IncidentModule(commands.Cog):
         m2 = await channel.send('If you do not add any proof, this ticket might be closed without further notice.')
 
 
-        TinyConnector.extend_cleanup_queue(channel_id, [m1.id, m2.id])
+        await TinyConnector.extend_cleanup_queue(channel_id, [m1.id, m2.id])
 
 
 
-    async def incident_notify_offender(self, guild, channel_id, incident_id, check_proof_exists):
+    async def incident_notify_offender(self, guild, channel_id, incident: Incident, check_proof_exists):
 
-        server = TinyConnector.get_settings(guild.id)
-        incident = TinyConnector.get_incident(incident_id)
+        server = await TinyConnector.get_settings(guild.id)
 
-        victim = await guild.fetch_member(incident.victim.u_id)
-        offender = await guild.fetch_member(incident.offender.u_id)
+        victim = await MemberResolver.get_member(guild, incident.victim.u_id)
+        offender = await MemberResolver.get_member(guild, incident.offender.u_id)
 
         # do not change state-machine yet
         # next step requires a valid offender-id to be entered
@@ -240,14 +404,19 @@ class IncidentModule(commands.Cog):
                 m1 = await channel.send('Are you sure you don\'t want to add any proof?\nThe incident might get cancelled if no sufficient evidence is provided.')
                 m2 = await channel.send('If you decide to not add further evidence, confirm this with a text message (e.g. `no evidence required`) and react again.')
 
-                TinyConnector.extend_cleanup_queue(channel_id, [m1.id, m2.id])
+                await TinyConnector.extend_cleanup_queue(channel_id, [m1.id, m2.id])
                 return
 
 
         # # re-fetch the server-object, as it could have changed
-        # server = TinyConnector.get_guild(guild.id)
+        # server = await TinyConnector.get_guild(guild.id)
         # incident = server.active_incidents[incident_id]
 
+        # incr. state-machine on successfull offender-determination
+        # update before sending, the update must fail if the incident was advanced meanwhile
+        incident.state = State.OFFENDER_STATEMENT
+        await TinyConnector.update_incident(incident)
+
         offender_id = incident.offender.u_id
 
         q2 = await channel.send('<@{:d}> Please state your point of view and any other comments you want to add'.format(offender_id))
@@ -256,32 +425,25 @@ class IncidentModule(commands.Cog):
         comps = self._component_factory(allow_revert=True)
         msg = await channel.send('Use the navigation bar, once you\'re done', components=[comps])
 
-        # incr. state-machine on successfull offender-determination
-        incident = TinyConnector.get_incident(channel_id)
-
-        incident.state = State.OFFENDER_STATEMENT
-        TinyConnector.update_incident(incident)
-
         await self._set_offender_write(channel, victim, offender)
 
         # delete the old questions, this helps in keeping the channel clean
-        await self._del_msg_list(channel, incident.cleanup_queue)
-        TinyConnector.clear_cleanup_queue(channel_id)
+        self._cleanup_msg_list(channel, incident.cleanup_queue)
+        await TinyConnector.clear_cleanup_queue(channel_id)
 
         # this needs to be added, AFTER deleting the pending queue
-        TinyConnector.extend_cleanup_queue(channel_id, [msg.id, q2.id])
+        await TinyConnector.extend_cleanup_queue(channel_id, [msg.id, q2.id])
 
-        await channel.edit(name='🅾 ' + channel.name[1:])
+        self.rename_queue.request(channel, '🅾 ' + channel.name[1:])
 
 
 
-    async def incident_offender_proof(self, guild, channel_id, incident_id):
+    async def incident_offender_proof(self, guild, channel_id, incident: Incident):
 
-        server = TinyConnector.get_settings(guild.id)
-        incident = TinyConnector.get_incident(incident_id)
+        server = await TinyConnector.get_settings(guild.id)
 
         incident.state = State.OFFENDER_PROOF
-        TinyConnector.update_incident(incident)
+        await TinyConnector.update_incident(incident)
 
         # incident id is channel id
         channel = guild.get_channel(incident.channel_id)
@@ -295,22 +457,21 @@ class IncidentModule(commands.Cog):
                                     embed=embed,
                                     components=[comps])
 
-        await self._del_msg_list(channel, incident.cleanup_queue)
-        TinyConnector.clear_cleanup_queue(channel_id)
+        self._cleanup_msg_list(channel, incident.cleanup_queue)
+        await TinyConnector.clear_cleanup_queue(channel_id)
 
         # this needs to be added, AFTER deleting the pending queue
-        TinyConnector.extend_cleanup_queue(channel_id, [q1.id])
+        await TinyConnector.extend_cleanup_queue(channel_id, [q1.id])
 
 
 
 
-    async def incident_notify_stewards(self, guild, channel_id, incident_id, check_proof_exists):
+    async def incident_notify_stewards(self, guild, channel_id, incident: Incident, check_proof_exists):
 
-        server = TinyConnector.get_settings(guild.id)
-        incident = TinyConnector.get_incident(incident_id)
+        server = await TinyConnector.get_settings(guild.id)
 
-        victim = await guild.fetch_member(incident.victim.u_id)
-        offender = await guild.fetch_member(incident.offender.u_id)
+        victim = await MemberResolver.get_member(guild, incident.victim.u_id)
+        offender = await MemberResolver.get_member(guild, incident.offender.u_id)
 
         # incident id is channel id
         channel = guild.get_channel(incident.channel_id)
@@ -322,14 +483,14 @@ class IncidentModule(commands.Cog):
                 m1 = await channel.send('Are you sure you don\'t want to add any proof?')
                 m2 = await channel.send('If all important footage is already posted, confirm this with an arbitrary message (e.g. `no further evidence`) and react again.')
 
-                TinyConnector.extend_cleanup_queue(channel_id, [m1.id, m2.id])
+                await TinyConnector.extend_cleanup_queue(channel_id, [m1.id, m2.id])
                 return
 
 
         # only advance if proof check passes
-        incident = TinyConnector.get_incident(channel_id)
+        # do not re-fetch, the update must fail if the incident was advanced meanwhile
         incident.state = State.STEWARD_STATEMENT
-        TinyConnector.update_incident(incident)
+        await TinyConnector.update_incident(incident)
 
         await self._set_no_write(channel, victim, offender)
 
@@ -338,19 +499,18 @@ class IncidentModule(commands.Cog):
         q1 = await channel.send('<@&{:d}> please have a look at this incident and state your judgement.'.format(server.stewards_id),
                                 components=[comps])
 
-        await self._del_msg_list(channel, incident.cleanup_queue)
-        TinyConnector.clear_cleanup_queue(channel_id)
+        self._cleanup_msg_list(channel, incident.cleanup_queue)
+        await TinyConnector.clear_cleanup_queue(channel_id)
 
         # this needs to be added, AFTER deleting the pending queue
-        TinyConnector.extend_cleanup_queue(channel_id, [q1.id])
+        await TinyConnector.extend_cleanup_queue(channel_id, [q1.id])
 
-        await channel.edit(name = '🛂 ' + channel.name[1:])
+        self.rename_queue.request(channel, '🛂 ' + channel.name[1:])
 
 
-    async def incident_steward_sumup(self, guild, channel_id, incident_id):
+    async def incident_steward_sumup(self, guild, channel_id, incident: Incident):
 
-        server = TinyConnector.get_settings(guild.id)
-        incident = TinyConnector.get_incident(incident_id)
+        server = await TinyConnector.get_settings(guild.id)
 
         # incident.state += 1
 
@@ -368,35 +528,32 @@ class IncidentModule(commands.Cog):
         outcome = await get_client_response(self.client, q2, 300)
 
 
-        # re-fetch, as db could have changed
-        incident = TinyConnector.get_incident(incident_id)
-
+        # not re-fetched, the update fails if the ticket was advanced or modified while waiting
         # do not assign None, but use old/placeholder values
         incident.outcome = outcome or "N/A"
         incident.infringement = category or incident.infringement + ' (as reported by victim)'
 
-        TinyConnector.update_incident(incident)
+        await TinyConnector.update_incident(incident)
 
 
-        await self._del_msg_list(channel, incident.cleanup_queue)
-        TinyConnector.clear_cleanup_queue(channel_id)
+        self._cleanup_msg_list(channel, incident.cleanup_queue)
+        await TinyConnector.clear_cleanup_queue(channel_id)
 
         incident.cleanup_queue.extend([q1.id, q2.id])
-        TinyConnector.extend_cleanup_queue(channel_id, [q1.id, q2.id])
+        await TinyConnector.extend_cleanup_queue(channel_id, [q1.id, q2.id])
 
 
 
 
-    async def incident_steward_end_statement(self, guild, channel_id, incident_id):
+    async def incident_steward_end_statement(self, guild, channel_id, incident: Incident):
 
-        server = TinyConnector.get_settings(guild.id)
-        incident = TinyConnector.get_incident(incident_id)
+        server = await TinyConnector.get_settings(guild.id)
 
         incident.state = State.DISCUSSION_PHASE
-        TinyConnector.update_incident(incident)
+        await TinyConnector.update_incident(incident)
 
-        victim = await guild.fetch_member(incident.victim.u_id)
-        offender = await guild.fetch_member(incident.offender.u_id)
+        victim = await MemberResolver.get_member(guild, incident.victim.u_id)
+        offender = await MemberResolver.get_member(guild, incident.offender.u_id)
 
         # incident id is channel id
         channel = guild.get_channel(incident.channel_id)
@@ -414,17 +571,17 @@ class IncidentModule(commands.Cog):
 
         await self._set_all_write(channel, victim, offender)
 
-        await self._del_msg_list(channel, incident.cleanup_queue)
-        TinyConnector.clear_cleanup_queue(channel_id)
+        self._cleanup_msg_list(channel, incident.cleanup_queue)
+        await TinyConnector.clear_cleanup_queue(channel_id)
 
-        await channel.edit(name = '✅ ' + channel.name[1:])
+        self.rename_queue.request(channel, '✅ ' + channel.name[1:])
 
 
 
     async def incident_modify_outcome(self, guild, channel_id, incident_id, editing_steward):
 
-        server = TinyConnector.get_settings(guild.id)
-        incident = TinyConnector.get_incident(incident_id)
+        server = await TinyConnector.get_settings(guild.id)
+        incident = await TinyConnector.get_incident(incident_id)
 
         # incident id is channel id
         channel = guild.get_channel(incident.channel_id)
@@ -444,7 +601,7 @@ class IncidentModule(commands.Cog):
 
         # re-fetch, as db could have changed
         # only assign if outcome has changed
-        incident = TinyConnector.get_incident(incident_id)
+        incident = await TinyConnector.get_incident(incident_id)
         is_modified = False
 
         if infringement and infringement != '-':
@@ -456,7 +613,7 @@ class IncidentModule(commands.Cog):
             is_modified = True
 
         if is_modified:
-            TinyConnector.update_incident(incident)
+            await TinyConnector.update_incident(incident)
 
             await dm.send('Done')
 
@@ -467,15 +624,14 @@ class IncidentModule(commands.Cog):
             await dm.send('No modification performed.')
 
 
-    async def incident_close_incident(self, guild, channel_id, incident_id):
+    async def incident_close_incident(self, guild, channel_id, incident: Incident):
 
-        server = TinyConnector.get_settings(guild.id)
-        incident = TinyConnector.get_incident(channel_id)
+        server = await TinyConnector.get_settings(guild.id)
 
         incident.state = State.CLOSED_PHASE
         incident.locked_time = datetime.utcnow()
 
-        TinyConnector.update_incident(incident)
+        await TinyConnector.update_incident(incident)
 
         # incident id is channel id
         channel = guild.get_channel(incident.channel_id)
@@ -484,34 +640,68 @@ class IncidentModule(commands.Cog):
             statement_ch = guild.get_channel(server.statement_ch_id)
             await statement_ch.send(embed = incident_embed(incident, channel.name[2:], incident.race_name))
 
-        await channel.send('The ticket is closed, please do not interact with this channel anymore.')
+        if incident.transcript:
+            # messages whose events are still in flight, or were lost
+            await self._backfill_transcript(channel)
+
+        closed_msg = await channel.send('The ticket is closed, please do not interact with this channel anymore.')
+
+        # don't rely on the gateway event arriving before the report is generated
+        TinyConnector.put_transcript_message(TranscriptMessage.from_message(closed_msg))
 
         # wolfpack specific file server
         if server.log_ch_id:
             log_ch = guild.get_channel(server.log_ch_id)
 
-            if guild.id in fileserver_whitelist:
-                html_str = await gen_html_report(channel, incident.victim.u_id, incident.offender.u_id, server.stewards_id, self.client.user.id)
-
-                if html_str:
-                    # generate folder structure and url
-                    file_path = f'{channel.name[2:]}.html'
-                    with open(f'{archive_directory}/{file_path}', 'w', encoding='utf-8') as fp:
-                        fp.write(html_str)
+            # the search index is fed by the same message iteration as the report
+            transcript_text = TranscriptCollector()
 
-                    await log_ch.send('get a link to the ticket log with `/incident logs`')
+            if guild.id in fileserver_whitelist:
+                # generate folder structure and url
+                file_path = f'{archive_directory}/{channel.name[2:]}.html'
+                ndjson_path = f'{archive_directory}/{channel.name[2:]}.ndjson.gz'
+
+                # attachments are shared by all reports of the guild, identical images are stored once
+                blobs = BlobStore(f'{archive_directory}/blobs/{guild.id}', f'blobs/{guild.id}')
+
+                # stream into temporary files, the reports only become visible once complete
+                # the machine-readable transcript is written in the same pass as the html report
+                try:
+                    with open(file_path + '.tmp', 'w', encoding='utf-8') as fp, gzip.open(ndjson_path + '.tmp', 'wt', encoding='utf-8') as nd_fp:
+                        msg_cnt = await write_html_report(fp, self.downloader, self._get_transcript(channel, incident), incident.victim.u_id, incident.offender.u_id, server.stewards_id, self.client.user.id,
+                                                          image_src=blobs.put, compressor=self.image_compressor, exporters=[NdjsonExporter(nd_fp), transcript_text])
+                    os.replace(file_path + '.tmp', file_path)
+                    os.replace(ndjson_path + '.tmp', ndjson_path)
+                except BaseException:
+                    # don't leave incomplete reports behind (also on cancellation)
+                    for tmp_path in [file_path + '.tmp', ndjson_path + '.tmp']:
+                        try:
+                            os.remove(tmp_path)
+                        except FileNotFoundError:
+                            pass
+                    raise
+
+                await log_ch.send(f'{channel.name[2:]}: {msg_cnt} messages exported. Get a link to the ticket log with `/incident logs`')
 
             # all other servers
             else:
                 # post the report summary in the incident channel, until the design is improved
-                html_str = await gen_html_report(channel, incident.victim.u_id, incident.offender.u_id, server.stewards_id, self.client.user.id)
+                f_p = io.StringIO()
+                msg_cnt = await write_html_report(f_p, self.downloader, self._get_transcript(channel, incident), incident.victim.u_id, incident.offender.u_id, server.stewards_id, self.client.user.id,
+                                                  compressor=self.image_compressor, exporters=[transcript_text])
 
-                if html_str:
-                    f_p = io.StringIO(html_str)
-                    await log_ch.send(file=discord.File(fp=f_p, filename=channel.name[2:] + '.html'))
+                f_p.seek(0)
+                await log_ch.send(f'{channel.name[2:]}: {msg_cnt} messages exported', file=discord.File(fp=f_p, filename=channel.name[2:] + '.html'))
 
-        await channel.edit(name= '🔒 ' + channel.name[1:])
-        print('renamed channel to locked state')
+            # the ticket is archived already, a failed index update must not interrupt closing
+            try:
+                await SearchIndex.add_incident(incident, channel.name[2:], transcript_text.get_text())
+            except Exception as e:
+                print('failed to update the search index:')
+                print(e)
+
+        self.rename_queue.request(channel, '🔒 ' + channel.name[1:])
+        print('queued rename to locked state')
 
 
     async def incident_delete(self, incident_id):
@@ -525,21 +715,22 @@ class IncidentModule(commands.Cog):
 
         # incident id is channel id
         channel = self.client.get_channel(incident_id)
-        TinyConnector.delete_incident(incident_id)
+        await TinyConnector.delete_incident(incident_id)
+        self.channel_activity.pop(incident_id, None)
+        self.rename_queue.cancel(incident_id)
 
         # silent fail?
         await channel.delete()
 
 
-    async def revert_incident_state(self, guild, channel_id, incident_id):
+    async def revert_incident_state(self, guild, channel_id, incident: Incident):
 
-        server = TinyConnector.get_settings(guild.id)
-        incident = TinyConnector.get_incident(channel_id)
+        server = await TinyConnector.get_settings(guild.id)
 
         # incident id is channel id
         channel = guild.get_channel(incident.channel_id)
-        victim = await guild.fetch_member(incident.victim.u_id)
-        offender = await guild.fetch_member(incident.offender.u_id)
+        victim = await MemberResolver.get_member(guild, incident.victim.u_id)
+        offender = await MemberResolver.get_member(guild, incident.offender.u_id)
 
         if incident.state == State.VICTIM_STATEMENT:
             await channel.send('You cannot revert this ticket any further.'\
@@ -550,33 +741,34 @@ class IncidentModule(commands.Cog):
             # there's no fixed method for this question
             # permissions do not change between states V_PROOF and V_STATEMENT
 
+            incident.state = State.VICTIM_STATEMENT
+            await TinyConnector.update_incident(incident)
+
             req1 = await channel.send('Please take 1 or 2 paragraphs to state what happened, what effect it had on your race and '\
                                 'why you think its a punishable behaviour (do not post links to footage yet)')
 
-            incident.cleanup_queue.append(req1.id)
-            incident.state = State.VICTIM_STATEMENT
-            TinyConnector.update_incident(incident)
+            await TinyConnector.extend_cleanup_queue(channel.id, [req1.id])
 
             await self._set_victim_write(channel, victim, offender)
 
         elif incident.state == State.OFFENDER_STATEMENT:
-            await self.incident_victim_proof(guild, channel.id, incident.channel_id)
+            await self.incident_victim_proof(guild, channel.id, incident)
             await self._set_victim_write(channel, victim, offender)
 
         elif incident.state == State.OFFENDER_PROOF:
-            await self.incident_notify_offender(guild, channel.id, incident.channel_id, check_proof_exists=False)
+            await self.incident_notify_offender(guild, channel.id, incident, check_proof_exists=False)
             await self._set_offender_write(channel, victim, offender)
 
         elif incident.state == State.STEWARD_STATEMENT:
-            await self.incident_offender_proof(guild, channel.id, incident.channel_id)
+            await self.incident_offender_proof(guild, channel.id, incident)
             await self._set_offender_write(channel, victim, offender)
 
         elif incident.state == State.DISCUSSION_PHASE:
-            await self.incident_notify_stewards(guild, channel.id, incident.channel_id, check_proof_exists=False)
+            await self.incident_notify_stewards(guild, channel.id, incident, check_proof_exists=False)
             await self._set_no_write(channel, victim, offender)
 
         elif incident.state == State.CLOSED_PHASE:
-            await self.incident_steward_end_statement(guild, channel.id, incident.channel_id)
+            await self.incident_steward_end_statement(guild, channel.id, incident)
             await self._set_all_write(channel, victim, offender)
 
 
@@ -588,6 +780,16 @@ class IncidentModule(commands.Cog):
     async def on_ready(self):
         print('IncidentModule loaded')
 
+        # a new gateway session, all events since the last one are lost
+        self.channel_activity.clear()
+        self._run_in_background(self._backfill_open_transcripts())
+
+
+    @commands.Cog.listener()
+    async def on_resumed(self):
+        # the gateway replays the missed events on resume, this only covers events dropped nevertheless
+        self._run_in_background(self._backfill_open_transcripts())
+
 
 
     @commands.Cog.listener()
@@ -601,64 +803,217 @@ class IncidentModule(commands.Cog):
         existing = TinyConnector.update_incident_msg_ts(message.channel.id)
 
         if existing:
+            activity = self.channel_activity.setdefault(message.channel.id, ChannelActivity())
+            activity.add_message(message, self.client.user.id)
+
+            TinyConnector.put_transcript_message(TranscriptMessage.from_message(message))
+
             if message.content and message.content == '⏩':
                 m = await message.channel.send('In order to advance the ticket, you need to *click* the ⏩-Button on the navigation bar')
                 #incident.cleanup_queue.append(m.id)
 
 
-    @tasks.loop(minutes=5)
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload):
+
+        if not TinyConnector.is_incident_channel(payload.channel_id):
+            return
+
+        channel = self.client.get_channel(payload.channel_id)
+
+        if all(key in payload.data for key in message_update_fields):
+            # content edits carry the complete message
+            message = discord.Message(state=self.client._connection, channel=channel, data=payload.data)
+        elif payload.cached_message:
+            # partial update (e.g. embeds of a link preview), applied to the cached message, like discord.py does
+            message = copy.copy(payload.cached_message)
+            message._update(payload.data)
+        else:
+            try:
+                message = await channel.fetch_message(payload.message_id)
+            except discord.errors.NotFound:
+                return
+
+        TinyConnector.put_transcript_message(TranscriptMessage.from_message(message))
+
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+
+        if TinyConnector.is_incident_channel(payload.channel_id):
+            TinyConnector.delete_transcript_messages([payload.message_id])
+
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload):
+
+        if TinyConnector.is_incident_channel(payload.channel_id):
+            TinyConnector.delete_transcript_messages(payload.message_ids)
+
+
+    @tasks.loop(seconds=30)
+    async def flush_msg_ts(self):
+        # coalesces all messages of the last interval into one write per channel
+        # failed writes are re-queued, don't let them stop the loop
+        try:
+            await TinyConnector.flush_incident_msg_ts()
+        except Exception as e:
+            print('failed to flush message timestamps:')
+            print(e)
+
+        # transcript changes of the last interval are written in a single bulk write
+        try:
+            await TinyConnector.flush_transcript()
+        except Exception as e:
+            print('failed to flush transcripts:')
+            print(e)
+
+
+    @flush_msg_ts.after_loop
+    async def after_flush_msg_ts(self):
+        # also runs when the loop is cancelled on shutdown
+        await TinyConnector.flush_incident_msg_ts()
+        await TinyConnector.flush_transcript()
+
+
+    @tasks.loop(seconds=0)
     async def incident_timeout(self):
-        t = datetime.utcnow()
+        # sleeps until the earliest incident deadline expired
+        channel_ids = await TinyConnector.deadlines.wait_due()
+
+        # the deadlines rely on last_msg, make sure it is up to date
+        try:
+            await TinyConnector.flush_incident_msg_ts()
+        except Exception as e:
+            print('failed to flush message timestamps:')
+            print(e)
+
+        # don't wait for the batch, a long running transition must not delay later deadlines
+        self._run_in_background(self._process_timeout_batch(channel_ids))
+
+
+    async def _process_timeout_batch(self, channel_ids):
+        start = time.monotonic()
+
+        await asyncio.gather(*[self._process_due(channel_id) for channel_id in channel_ids])
+
+        elapsed = time.monotonic() - start
+        print(f'processed {len(channel_ids)} due incident(s) in {elapsed:.2f}s ({len(channel_ids)/max(elapsed, 0.001):.1f}/s)')
+
+
+    @contextlib.asynccontextmanager
+    async def _timeout_slot(self, guild_id):
+        # incidents of the same guild are serialized, due to the per-route rate limits
+        lock = self.timeout_guild_locks.get(guild_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.timeout_guild_locks[guild_id] = lock
+
+        async with lock, self.timeout_semaphore:
+            yield
+
+
+    async def _process_due(self, channel_id):
+        try:
+            await self._process_timeout(channel_id)
+
+        except IncidentConflictError:
+            # modified at the same time, re-evaluated with the retry below
+            pass
+        except Exception as e:
+            print(f'failed to process timeout of incident {channel_id}:')
+            print(e)
+
+        # the incident did not advance (e.g. missing channel or failed transition)
+        # a successful transition re-schedules the incident by itself
+        if TinyConnector.is_incident_channel(channel_id) and not TinyConnector.deadlines.is_scheduled(channel_id):
+            TinyConnector.deadlines.schedule(channel_id, datetime.utcnow() + timeout_retry_delay)
+
+
+    async def _get_due_incident(self, channel_id):
+        """the incident, if its current deadline expired
+           None otherwise, a deadline in the future is re-scheduled
+        """
+
+        incident = await TinyConnector.get_incident(channel_id)
+
+        if not incident:
+            return None
 
-        # query all incidents not modified since 1 hour
-        # this needs some filtering later, but reduced db access to a single query
-        incidents = TinyConnector.get_incident_modified_before(t-timedelta(hours=1))
+        # new messages might have extended the deadline since it was scheduled
+        deadline = incident.get_deadline()
 
-        for incident in incidents:
-            guild = self.client.get_guild(incident.g_id)  # guild is required for fetch_member in child methods
-            channel = self.client.get_channel(incident.channel_id)
+        if deadline is None:
+            return None
+        elif deadline > datetime.utcnow():
+            TinyConnector.deadlines.schedule(channel_id, deadline)
+            return None
 
-            delta = t - incident.last_msg
+        return incident
 
-            if channel is None:
-                # don't immediately delete incident if channel is not existing anymore
-                # discord gateway could be down
-                # TODO: decide later what to do
-                continue
 
-            if incident.state == State.VICTIM_STATEMENT and delta > timedelta(hours=1):
-                await self.incident_victim_proof(guild, channel.id, incident.channel_id)
+    async def _process_timeout(self, channel_id):
+        incident = await self._get_due_incident(channel_id)
+
+        if not incident:
+            return
+
+        guild = self.client.get_guild(incident.g_id)  # guild is required for member resolution in child methods
+        channel = self.client.get_channel(incident.channel_id)
+
+        if channel is None:
+            # don't immediately delete incident if channel is not existing anymore
+            # discord gateway could be down
+            # TODO: decide later what to do
+            return
+
+        interactive = incident.state == State.STEWARD_STATEMENT
+
+        if interactive:
+            # waits up to 10 minutes for the stewards, this must not occupy a slot
+            await self.incident_steward_sumup(guild, channel.id, incident)
+
+        async with self._timeout_slot(incident.g_id):
+            # re-checked in the slot, a transition of the same incident might have finished while waiting
+            if interactive:
+                # the messages of the sumup extended the deadline, it was already decided before the sumup
+                incident = await TinyConnector.get_incident(channel_id)
+                if not incident or incident.state != State.STEWARD_STATEMENT:
+                    return
+            else:
+                incident = await self._get_due_incident(channel_id)
+                if not incident:
+                    return
+
+            await self._process_timeout_transition(guild, channel, incident)
 
-            elif incident.state == State.VICTIM_PROOF and delta > timedelta(hours=2):
-                # if this fails, the state-machine will not advance
-                # this will lead to continuous pinging of the victim (by design)
-                await self.incident_notify_offender(guild, channel.id, incident.channel_id, check_proof_exists=False)
 
-            # offender got 2 day for initial statement
-            elif incident.state == State.OFFENDER_STATEMENT and delta > timedelta(days=1):
-                await self.incident_offender_proof(guild, channel.id, incident.channel_id)
+    async def _process_timeout_transition(self, guild, channel, incident):
+        # the timeouts of each state are defined in lib.data.STATE_TIMEOUTS
+        if incident.state == State.VICTIM_STATEMENT:
+            await self.incident_victim_proof(guild, channel.id, incident)
 
-            # further 2 hours for upload of proof
-            elif incident.state == State.OFFENDER_PROOF and delta > timedelta(hours=2):
-                await self.incident_notify_stewards(guild, channel.id, incident.channel_id, check_proof_exists=False)
+        elif incident.state == State.VICTIM_PROOF:
+            # if this fails, the state-machine will not advance
+            # this will lead to continuous pinging of the victim (by design)
+            await self.incident_notify_offender(guild, channel.id, incident, check_proof_exists=False)
 
-            # the stewards got 2 days of reaction
-            elif incident.state == State.STEWARD_STATEMENT and delta > timedelta(days=5):
-                await self.incident_steward_sumup(guild, channel.id, incident.channel_id)
-                await self.incident_steward_end_statement(guild, channel.id, incident.channel_id)
+        elif incident.state == State.OFFENDER_STATEMENT:
+            await self.incident_offender_proof(guild, channel.id, incident)
 
-            # the incident is auto-closed after 1 further day
-            elif incident.state == State.DISCUSSION_PHASE and delta > timedelta(days=2):
-                await self.incident_close_incident(guild, channel.id, incident.channel_id)
+        elif incident.state == State.OFFENDER_PROOF:
+            await self.incident_notify_stewards(guild, channel.id, incident, check_proof_exists=False)
 
+        elif incident.state == State.STEWARD_STATEMENT:
+            # the sumup was already done outside of the slot
+            await self.incident_steward_end_statement(guild, channel.id, incident)
 
-        incidents = TinyConnector.get_incident_locked_before(t-timedelta(days=2))
-        for incident in incidents:
-            # state 7 is closed incident with no further interaction
-            # this check is required, despite the specific query,
-            # as an incident could've been reverted
-            if incident.state == State.CLOSED_PHASE:
-                await self.incident_delete(incident.channel_id)
+        elif incident.state == State.DISCUSSION_PHASE:
+            await self.incident_close_incident(guild, channel.id, incident)
+
+        # closed incident with no further interaction
+        elif incident.state == State.CLOSED_PHASE:
+            await self.incident_delete(incident.channel_id)
 
 
     @incident_timeout.before_loop
@@ -680,42 +1035,55 @@ class IncidentModule(commands.Cog):
         channel = ctx.channel
         author_id = ctx.author_id
 
-        incident = TinyConnector.get_incident(channel.id)
-        server = TinyConnector.get_settings(guild.id)
+        incident = await TinyConnector.get_incident(channel.id)
+        server = await TinyConnector.get_settings(guild.id)
 
         if not incident:
             return
 
         await ctx.defer(edit_origin=True)
 
+        try:
+            await self._process_navigation(ctx, incident, server)
+        except IncidentConflictError:
+            # another steward or the timeout sweep advanced the ticket at the same time
+            await ctx.send('The ticket was modified at the same time, please try again', hidden=True)
+
+
+    async def _process_navigation(self, ctx: ComponentContext, incident, server):
+
+        guild = ctx.guild
+        channel = ctx.channel
+        author_id = ctx.author_id
+
         if ctx.component_id == 'incident_navigation_next':
             # advance over state-machine
             # increment the incident state before call, as async method could delay and lead to altered database
             if incident.state == State.VICTIM_STATEMENT and author_id == incident.victim.u_id:
-                await self.incident_victim_proof(guild, channel.id, incident.channel_id)
+                await self.incident_victim_proof(guild, channel.id, incident)
 
             elif incident.state == State.VICTIM_PROOF and author_id == incident.victim.u_id:
-                await self.incident_notify_offender(guild, channel.id, incident.channel_id, check_proof_exists=True)
+                await self.incident_notify_offender(guild, channel.id, incident, check_proof_exists=True)
 
             elif incident.state == State.OFFENDER_STATEMENT and author_id == incident.offender.u_id:
-                await self.incident_offender_proof(guild, channel.id, incident.channel_id)
+                await self.incident_offender_proof(guild, channel.id, incident)
 
             elif incident.state == State.OFFENDER_PROOF and author_id == incident.offender.u_id:
-                await self.incident_notify_stewards(guild, channel.id, incident.channel_id, check_proof_exists=True)
+                await self.incident_notify_stewards(guild, channel.id, incident, check_proof_exists=True)
 
             elif incident.state == State.STEWARD_STATEMENT and self._is_member_steward(ctx.author, server.stewards_id):
-                await self.incident_steward_sumup(guild, channel.id, incident.channel_id)
-                await self.incident_steward_end_statement(guild, channel.id, incident.channel_id)
+                await self.incident_steward_sumup(guild, channel.id, incident)
+                await self.incident_steward_end_statement(guild, channel.id, incident)
 
         elif ctx.component_id == 'incident_navigation_prev':
             if self._is_member_steward(ctx.author, server.stewards_id):
-                await self.revert_incident_state(guild, channel.id, incident.channel_id)
+                await self.revert_incident_state(guild, channel.id, incident)
             else:
                 await channel.send('Only stewards can revert the ticket state')
 
         elif ctx.component_id == 'incident_navigation_lock':
             if incident.state == State.DISCUSSION_PHASE and self._is_member_steward(ctx.author, server.stewards_id):
-                await self.incident_close_incident(guild, channel.id, incident.channel_id)
+                await self.incident_close_incident(guild, channel.id, incident)
 
         elif ctx.component_id == 'incident_navigation_edit':
             if incident.state == State.DISCUSSION_PHASE and self._is_member_steward(ctx.author, server.stewards_id):
@@ -728,7 +1096,7 @@ class IncidentModule(commands.Cog):
         emoji = payload.emoji.name
 
         if emoji == '⏩':
-            incident = TinyConnector.get_incident(payload.channel_id)
+            incident = await TinyConnector.get_incident(payload.channel_id)
 
             if incident:
                 guild = self.client.get_guild(payload.guild_id)
@@ -787,5 +1155,57 @@ class IncidentModule(commands.Cog):
             await ctx.send(f'Failed to create login credentials (code {resp.status_code}), please contact a moderator to resolve this issue')
 
 
+    @cog_ext.cog_subcommand(base='incident', name='search', description='search the closed incidents of this server (stewards)',
+                            options=[
+                                create_option(
+                                    name='query',
+                                    description='e.g. driver names or numbers, race name or words of the discussion',
+                                    required=True,
+                                    option_type=SlashCommandOptionType.STRING
+                                ),
+                                create_option(
+                                    name='page',
+                                    description='page of the results',
+                                    required=False,
+                                    option_type=SlashCommandOptionType.INTEGER
+                                )
+                            ])
+    @commands.guild_only()
+    async def incident_search(self, ctx: SlashContext, query, page=1):
+
+        server = await TinyConnector.get_settings(ctx.guild.id)
+
+        # the transcripts are not public
+        if not self._is_member_steward(ctx.author, server.stewards_id):
+            await ctx.send('Only stewards can search the incidents', hidden=True)
+            return
+
+        page = max(page, 1)
+        hits, total = await SearchIndex.search(ctx.guild.id, query, page)
+
+        # the embed title is limited to 256 characters
+        shown_query = query if len(query) <= 200 else query[:199] + '…'
+
+        if total == 0:
+            await ctx.send(f'No incidents found for `{shown_query}`', hidden=True)
+            return
+
+        page_cnt = (total + SearchIndex.page_size - 1) // SearchIndex.page_size
+
+        embed = discord.Embed(title=f'Incidents matching \'{shown_query}\'')
+
+        for hit in hits:
+            embed.add_field(name='{:s} ({:s})'.format(hit['ticket'], hit['closed']),
+                            value='{:s}\n{:s}\n{:s}'.format(hit['race_name'], hit['drivers'], hit['snippet'])[:1024],
+                            inline=False)
+
+        embed.set_footer(text=f'page {page} of {page_cnt} ({total} incidents)')
+
+        if not hits:
+            embed.description = f'There are only {page_cnt} pages'
+
+        await ctx.send(embed=embed, hidden=True)
+
+
 def setup(client):
     client.add_cog(IncidentModule(client))
@@ -105,9 +105,9 @@ class IncidentSettings(commands.Cog):
     async def incident_setup_steward(self, ctx: SlashContext, mode, role):
 
         if mode == 'steward':
-            server = TinyConnector.get_settings(ctx.guild.id)
+            server = await TinyConnector.get_settings(ctx.guild.id)
             server.stewards_id = int(role.id)
-            TinyConnector.update_settings(server)
+            await TinyConnector.update_settings(server)
 
             await ctx.send(f'New steward role is {role.mention}')
 
@@ -144,7 +144,7 @@ class IncidentSettings(commands.Cog):
                                 ])
     async def incident_setup_ticket(self, ctx: SlashContext, mode, channel):
 
-        server = TinyConnector.get_settings(ctx.guild.id)
+        server = await TinyConnector.get_settings(ctx.guild.id)
 
         if mode == 'category':
             if not isinstance(channel, discord.CategoryChannel):
@@ -170,7 +170,7 @@ class IncidentSettings(commands.Cog):
             server.log_ch_id = channel.id
             await ctx.send('The log channel will be `{:s}`'.format(channel.name))
 
-        TinyConnector.update_settings(server)
+        await TinyConnector.update_settings(server)
 
 
 def setup(client):
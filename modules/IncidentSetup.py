@@ -17,7 +17,7 @@ from discord_slash.utils.manage_commands import create_option, create_choice
 
 
 from lib.tinyConnector import TinyConnector
-from lib.data import Incident, Driver, State
+from lib.data import Incident, Driver, State, TranscriptMessage
 
 from consts import Consts
 
@@ -26,6 +26,7 @@ from util.verboseErrors import VerboseErrors
 from util.interaction import ack_message, get_client_response, get_client_reaction, wait_confirm_deny
 
 from util.displayEmbeds import incident_embed
+from util.memberResolver import MemberResolver
 
 
 class IncidentSetup(commands.Cog):
@@ -88,23 +89,23 @@ class IncidentSetup(commands.Cog):
     #################################################
 
 
-    async def _set_offender_write(self, channel, victim, offender):
-        await channel.set_permissions(victim, read_messages=True, send_messages=False, read_message_history=True)
-        await channel.set_permissions(offender, read_messages=True, send_messages=True, read_message_history=True)
+    def _get_channel_overwrites(self, guild, steward_role, victim, offender):
+        """permission overwrites of a new incident channel
+           only the victim can write in the initial state
+        """
 
+        overwrites = {
+            guild.default_role: discord.PermissionOverwrite(read_messages=False, send_messages=False, read_message_history=False),
+            guild.me: discord.PermissionOverwrite(manage_messages=True, read_messages=True, send_messages=True, read_message_history=True),
+            victim: discord.PermissionOverwrite(read_messages=True, send_messages=True, read_message_history=True),
+            offender: discord.PermissionOverwrite(read_messages=True, send_messages=False, read_message_history=True)
+        }
 
-    async def _set_victim_write(self, channel, victim, offender):
-        await channel.set_permissions(victim, read_messages=True, send_messages=True, read_message_history=True)
-        await channel.set_permissions(offender, read_messages=True, send_messages=False, read_message_history=True)
+        # the role could have been deleted since the setup
+        if steward_role:
+            overwrites[steward_role] = discord.PermissionOverwrite(read_messages=True, send_messages=True, read_message_history=True)
 
-    async def _set_all_write(self, channel, victim, offender):
-        await channel.set_permissions(victim, read_messages=True, send_messages=True, read_message_history=True)
-        await channel.set_permissions(offender, read_messages=True, send_messages=True, read_message_history=True)
-
-
-    async def _set_no_write(self, channel, victim, offender):
-        await channel.set_permissions(victim, read_messages=True, send_messages=False, read_message_history=True)
-        await channel.set_permissions(offender, read_messages=True, send_messages=False, read_message_history=True)
+        return overwrites
 
 
 
@@ -122,7 +123,7 @@ class IncidentSetup(commands.Cog):
         perms.manage_permissions = True
         perms.embed_links = True
 
-        server = TinyConnector.get_settings(cmd.guild.id)
+        server = await TinyConnector.get_settings(cmd.guild.id)
 
         if not server.incident_section_id:
             await cmd.send('You need to setup a section for incidents first. Please ask an admin to use `/incident setup`')
@@ -209,8 +210,7 @@ class IncidentSetup(commands.Cog):
         success = await self.incident_setup_channel(stm)
 
         if success:
-            TinyConnector.incr_inc_cnt(stm.guild.id)
-            TinyConnector.update_incident(stm.incident)
+            await TinyConnector.update_incident(stm.incident)
 
             await stm.dm.send('I tagged you in the appropriate incident channel.')
 
@@ -539,51 +539,32 @@ class IncidentSetup(commands.Cog):
 
     async def incident_setup_channel(self, stm):
 
-        # need update for incident number, otherwise concurrent access might break sequential numbering
-        server = TinyConnector.get_settings(stm.guild.id)
-        incident_cnt = TinyConnector.get_inc_cnt(stm.guild.id)
-
-        # create channel and ask user for more input
-        ch_name = '🅰 Incident Ticket - {:d}'.format(incident_cnt + 1)
+        server = await TinyConnector.get_settings(stm.guild.id)
 
         section = self.client.get_channel(server.incident_section_id)
         steward_role = stm.guild.get_role(server.stewards_id)
 
-        offender = await stm.guild.fetch_member(stm.incident.offender.u_id)
+        offender = await MemberResolver.get_member(stm.guild, stm.incident.offender.u_id)
 
         if section is None:
             await stm.dm.send('Failed to create a channel, please ask an admin to re-set the category with `/incident setup`')
             return False
 
+        # allocate and increment in one step, concurrent reports must never share a number
+        incident_cnt = await TinyConnector.allocate_inc_cnt(stm.guild.id)
 
-        inc_channel = await stm.guild.create_text_channel(ch_name, category=section)
-        stm.incident.channel_id = inc_channel.id
-
-
-        # ===================================
-        # THO ORDER OF THIS IS VERY IMPORTANT
-        # @EVERYONE NEEDS TO BE SET LAST
-        # ===================================
-
-        try:
-            await inc_channel.set_permissions(stm.guild.me, manage_messages=True, read_messages=True, send_messages=True, read_message_history=True)
-        except Exception as e:
-            print('bot permissions:')
-            print(e)
+        # create channel and ask user for more input
+        ch_name = '🅰 Incident Ticket - {:d}'.format(incident_cnt)
 
-        try:
-            await inc_channel.set_permissions(steward_role, read_messages=True, send_messages=True, read_message_history=True)
-        except Exception as e:
-            print('steward permission:')
-            print(e)
+        # all permissions are set in the same call which creates the channel
+        # the channel is never visible to @everyone
+        overwrites = self._get_channel_overwrites(stm.guild, steward_role, stm.author, offender)
 
-        await self._set_victim_write(inc_channel, stm.author, offender)
+        inc_channel = await stm.guild.create_text_channel(ch_name, category=section, overwrites=overwrites)
+        stm.incident.channel_id = inc_channel.id
 
-        try:
-            await inc_channel.set_permissions(stm.guild.default_role, read_messages=False, send_messages=False, read_message_history=False)
-        except Exception as e:
-            print('everyone permissions:')
-            print(e)
+        # every message of the channel is captured from now on
+        stm.incident.transcript = True
 
 
         buttons = [
@@ -615,6 +596,10 @@ class IncidentSetup(commands.Cog):
         stm.incident.cleanup_queue.append(req1.id)
         stm.incident.cleanup_queue.append(req2.id)
 
+        # sent before the incident is stored, on_message doesn't know the channel yet
+        for msg in [embed_msg, req1, req2]:
+            TinyConnector.put_transcript_message(TranscriptMessage.from_message(msg))
+
         return True
 
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the bot is run from the repository root, not installed as a package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
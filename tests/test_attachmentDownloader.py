@@ -0,0 +1,124 @@
+"""tests of the attachment downloader against a local aiohttp test server"""
+
+import time
+import asyncio
+import collections
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from aiohttp import web
+
+import util.attachmentDownloader
+from util.attachmentDownloader import AttachmentDownloader
+
+
+def _run(test, monkeypatch):
+    """run the coroutine function test(base_url, hits) against the test server
+       hits counts the requests per path
+    """
+
+    # keep the retries fast
+    monkeypatch.setattr(util.attachmentDownloader, 'retry_backoff', 0.01)
+
+    hits = collections.Counter()
+
+    async def delay(request):
+        hits[request.path] += 1
+        await asyncio.sleep(int(request.match_info['ms']) / 1000)
+        return web.Response(body=request.path.encode())
+
+    async def flaky(request):
+        # fails with the given status, until the last attempt
+        hits[request.path] += 1
+        if hits[request.path] < util.attachmentDownloader.download_retries:
+            return web.Response(status=int(request.match_info['status']))
+        return web.Response(body=b'ok')
+
+    async def status(request):
+        hits[request.path] += 1
+        return web.Response(status=int(request.match_info['status']))
+
+    async def _wrapper():
+        app = web.Application()
+        app.router.add_get('/delay/{ms}', delay)
+        app.router.add_get('/flaky/{status}', flaky)
+        app.router.add_get('/status/{status}', status)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+
+        port = runner.addresses[0][1]
+        try:
+            await test(f'http://127.0.0.1:{port}', hits)
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(_wrapper())
+
+
+def test_downloads_run_concurrently(monkeypatch):
+    async def _test(base_url, hits):
+        downloader = AttachmentDownloader()
+        delays = [200, 300, 600]
+
+        try:
+            start = time.monotonic()
+            results = await asyncio.gather(*(downloader.fetch(f'{base_url}/delay/{ms}') for ms in delays))
+            elapsed = time.monotonic() - start
+        finally:
+            await downloader.close()
+
+        assert results == [f'/delay/{ms}'.encode() for ms in delays]
+
+        # the total time tracks the slowest image, not the sum of all
+        assert max(delays) / 1000 <= elapsed < sum(delays) / 1000
+
+    _run(_test, monkeypatch)
+
+
+@pytest.mark.parametrize('status', [500, 503, 429])
+def test_server_errors_are_retried(monkeypatch, status):
+    async def _test(base_url, hits):
+        downloader = AttachmentDownloader()
+        try:
+            content = await downloader.fetch(f'{base_url}/flaky/{status}')
+        finally:
+            await downloader.close()
+
+        assert content == b'ok'
+        assert hits[f'/flaky/{status}'] == util.attachmentDownloader.download_retries
+
+    _run(_test, monkeypatch)
+
+
+def test_retries_are_limited(monkeypatch):
+    async def _test(base_url, hits):
+        downloader = AttachmentDownloader()
+        try:
+            content = await downloader.fetch(f'{base_url}/status/500')
+        finally:
+            await downloader.close()
+
+        assert content is None
+        assert hits['/status/500'] == util.attachmentDownloader.download_retries
+
+    _run(_test, monkeypatch)
+
+
+@pytest.mark.parametrize('status', [403, 404])
+def test_client_errors_are_not_retried(monkeypatch, status):
+    async def _test(base_url, hits):
+        downloader = AttachmentDownloader()
+        try:
+            content = await downloader.fetch(f'{base_url}/status/{status}')
+        finally:
+            await downloader.close()
+
+        assert content is None
+        assert hits[f'/status/{status}'] == 1
+
+    _run(_test, monkeypatch)
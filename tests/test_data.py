@@ -0,0 +1,76 @@
+"""unit tests of the incident deadlines, with a fake clock"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import lib.deadlineQueue
+from lib.data import Incident, State, STATE_TIMEOUTS
+from lib.deadlineQueue import DeadlineQueue
+
+
+class _FakeClock(datetime):
+    now_utc = datetime(2021, 6, 1, 20, 0)
+
+    @classmethod
+    def utcnow(cls):
+        return cls.now_utc
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    monkeypatch.setattr(lib.deadlineQueue, 'datetime', _FakeClock)
+    monkeypatch.setattr(_FakeClock, 'now_utc', datetime(2021, 6, 1, 20, 0))
+    return _FakeClock
+
+
+def _loaded_incident(state, last_msg):
+    # '_id' marks the incident as loaded from the db
+    return Incident({'_id': 'x', 'channel_id': 42, 'g_id': 1, 'state': state.value, 'last_msg': last_msg})
+
+
+def test_transition_does_not_make_next_state_due(clock):
+    # the offender statement timed out, the last message is older than a day
+    incident = _loaded_incident(State.OFFENDER_STATEMENT, clock.utcnow() - timedelta(days=1, hours=1))
+    assert incident.get_deadline() < clock.utcnow()
+
+    incident.state = State.OFFENDER_PROOF
+    deadline = incident._update_deadline(clock.utcnow())
+
+    # the proof window starts with the transition
+    assert deadline == clock.utcnow() + STATE_TIMEOUTS[State.OFFENDER_PROOF]
+    assert incident.next_deadline == deadline
+    assert 'last_msg' in incident._dirty
+
+    async def _test():
+        queue = DeadlineQueue()
+        queue.schedule(incident.channel_id, deadline)
+
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(queue.wait_due(), 0.05)
+
+        clock.now_utc = deadline
+        assert await asyncio.wait_for(queue.wait_due(), 0.05) == [incident.channel_id]
+
+    asyncio.run(_test())
+
+
+def test_update_without_transition_keeps_message_deadline(clock):
+    last_msg = clock.utcnow() - timedelta(minutes=30)
+    incident = _loaded_incident(State.VICTIM_PROOF, last_msg)
+
+    incident.outcome = 'no further action'
+    deadline = incident._update_deadline(clock.utcnow())
+
+    assert deadline == last_msg + STATE_TIMEOUTS[State.VICTIM_PROOF]
+    assert 'last_msg' not in incident._dirty
+
+
+def test_closed_deadline_counts_from_locking(clock):
+    incident = _loaded_incident(State.DISCUSSION_PHASE, clock.utcnow() - timedelta(days=3))
+
+    incident.state = State.CLOSED_PHASE
+    incident.locked_time = clock.utcnow()
+
+    assert incident._update_deadline(clock.utcnow()) == clock.utcnow() + STATE_TIMEOUTS[State.CLOSED_PHASE]
@@ -0,0 +1,69 @@
+import os
+import asyncio
+
+import aiohttp
+
+
+download_concurrency = int(os.getenv('REPORT_DOWNLOAD_CONCURRENCY', '8'))
+download_timeout = float(os.getenv('REPORT_DOWNLOAD_TIMEOUT', '30'))  # seconds, per attempt
+download_retries = 3
+retry_backoff = 0.5  # seconds, doubled after each failed attempt
+
+
+class AttachmentDownloader:
+    """downloads attachments through a shared http session
+       at most download_concurrency downloads run at the same time
+
+       the session is created on first use, as it must live in the running event loop
+    """
+
+    def __init__(self):
+        self._session = None
+        self._semaphore = asyncio.Semaphore(download_concurrency)
+
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=download_concurrency)
+            timeout = aiohttp.ClientTimeout(total=download_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+        return self._session
+
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+    async def fetch(self, url):
+        """download url, retries on timeouts, connection errors and server errors
+
+        Returns:
+            bytes: content of the response, None if the download failed
+        """
+
+        session = self._get_session()
+        delay = retry_backoff
+
+        async with self._semaphore:
+            for attempt in range(download_retries):
+                try:
+                    async with session.get(url) as resp:
+                        if resp.status == 200:
+                            return await resp.read()
+
+                        # client errors won't resolve by retrying
+                        if resp.status < 500 and resp.status != 429:
+                            print(f'failed to download attachment, status {resp.status}')
+                            return None
+
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    print(f'failed to download attachment (attempt {attempt+1}): {e!r}')
+
+                if attempt + 1 < download_retries:
+                    await asyncio.sleep(delay)
+                    delay *= 2
+
+        return None
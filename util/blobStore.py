@@ -0,0 +1,45 @@
+import os
+import hashlib
+import threading
+
+
+class BlobStore:
+    """content-addressed file store
+       each file is named after the sha256 of its content and written only once,
+       reposted attachments share a single file
+
+       put is thread-safe, it's called in the default executor
+    """
+
+    def __init__(self, root: str, url_prefix: str):
+        """
+        Args:
+            root (str): directory the blobs are written to, created on demand
+            url_prefix (str): path of root as referenced in the html report
+        """
+        self.root = root
+        self.url_prefix = url_prefix
+
+
+    def put(self, content: bytes, filename: str):
+        """store content, NOP if an identical blob already exists
+
+        Returns:
+            str: url of the blob, relative to the report
+        """
+
+        ext = os.path.splitext(filename)[1].lower()
+        name = hashlib.sha256(content).hexdigest() + ext
+        path = os.path.join(self.root, name)
+
+        if not os.path.exists(path):
+            os.makedirs(self.root, exist_ok=True)
+
+            # a partially written blob must never be visible under its final name
+            # the same image might be stored by another thread at the same time
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as fp:
+                fp.write(content)
+            os.replace(tmp_path, path)
+
+        return f'{self.url_prefix}/{name}'
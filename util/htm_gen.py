@@ -1,179 +1,276 @@
-import discord
+import os
 import codecs
 
 import base64
-import requests
+import hashlib
+import asyncio
+from collections import deque
 
 
-def _is_member_steward(member, steward_id):
-    # cannot determin roles, if the user isn't a member
-    if isinstance(member, discord.Member):
-        return any(r.id == steward_id for r in member.roles)
-    else:
-        return False
+# number of messages whose attachments are downloaded ahead of rendering
+prefetch_window = 20
+
+
+# the report template is read once, and re-read only if the file changed on disk
+template_path = os.path.join(os.path.dirname(__file__), 'template.html')
+_template = None
+_template_mtime = None
+
+
+def _get_template():
+    global _template, _template_mtime
+
+    mtime = os.stat(template_path).st_mtime
+
+    if mtime != _template_mtime:
+        with open(template_path, 'r') as t_file:
+            _template = ' '.join(t_file.readlines())
+        _template_mtime = mtime
+
+    return _template
+
+
+_get_template()
+
+
+# fragment renderers, one bound format() per html block
+_render_msg_head = ('   <div class="container {:s}">\n'\
+                    '       <div class="avatar mr-25">\n'\
+                    '           <img class="row imgProfile" src="{:s}" alt="Avatar">\n'\
+                    '           <span class="row name">{:s}</span>\n'\
+                    '       </div>\n'\
+                    '\n'\
+                    '       <div class="comments mr-25">\n'\
+                    '           <p>{:s}</p>\n').format
+
+_render_msg_tail = ('       </div>'\
+                    '\n'\
+                    '       <div class="time row">\n'\
+                    '           <p>{:s}</br>\n'\
+                    '           {:s}</p>\n'\
+                    '       </div>\n'\
+                    '   </div>\n\n').format
+
+_render_paragraph = '           <p>{:s}</p>\n'.format
+
+_render_attachment = '           <img alt="" src="{:s}" />\n'.format
+
+_render_avatar_url = 'https://cdn.discordapp.com/avatars/{:d}/{:s}.png'.format
+
+_render_embed_head = ('			<div class="embed">\n'\
+                      '  			  <div></div>\n'\
+                      '  			    <div>\n'\
+                      '                 <h3>{:s}</h3>\n'\
+                      '                 <p>{:s}</p>\n'\
+                      '                   <div class="content">\n').format
+
+_embed_tail = '                 </div>\n'\
+              '               </div>\n'\
+              '           </div>\n'
+
+_embed_column_head = '                     <div>\n'\
+                     '                       <ul class="ulEmbed">\n'
+
+_render_embed_field = ('                         <li>\n'\
+                       '                           <h4 class="hEmbed">{:s}</h4>\n'\
+                       '                           <p>{:s}</p>\n'\
+                       '                         </li>\n'\
+                       '                         <li><br></li>\n').format
+
+_embed_column_tail = '                       </ul>\n'\
+                     '                     </div>\n'
 
 
 def _gen_embed_column(field_list: []):
+    return _embed_column_head\
+           + ''.join([_render_embed_field(field['name'], field['value']) for field in field_list])\
+           + _embed_column_tail
+
 
-    html = '                     <div>\n'\
-           '                       <ul class="ulEmbed">\n'\
+def _gen_embed(embed):
+    # fields are alternately placed in the left and right column
+    return _render_embed_head(embed['title'] or '', embed['description'])\
+           + _gen_embed_column(embed['fields'][0::2])\
+           + _gen_embed_column(embed['fields'][1::2])\
+           + _embed_tail
 
-    for field in field_list:
-        html += '                         <li>\n'\
-                '                           <h4 class="hEmbed">{:s}</h4>\n'\
-                '                           <p>{:s}</p>\n'\
-                '                         </li>\n'\
-                '                         <li><br></li>\n'.format(field.name, field.value)
 
-    html += '                       </ul>\n'\
-            '                     </div>\n'
+def get_author_role(msg, victim_id, offender_id, steward_id, bot_id):
+    """role of the message author in the incident
+       offender, bot, steward, victim or other
+    """
 
-    return html
+    # checked in order, a steward could also be involved in the incident
+    if msg.author_id == offender_id:
+        return 'offender'
+    elif msg.author_id == bot_id:
+        return 'bot'
+    elif steward_id in msg.author_roles:
+        return 'steward'
+    elif msg.author_id == victim_id:
+        return 'victim'
 
+    return 'other'
 
 
+def _gen_message(msg, author_role, images):
+    """render a single message (TranscriptMessage) as html
+       images holds the img src of each attachment (None if skipped or failed)
+       returns a list of html chunks
+    """
 
+    # victim and other participants share the default style
+    h_type = author_role if author_role in ['offender', 'bot', 'steward'] else ' '
 
-async def gen_html_report(channel, victim_id, offender_id, steward_id, bot_id):
 
-    messages = await channel.history(limit=200).flatten()
+    if msg.author_avatar:
+        avatar_url = _render_avatar_url(msg.author_id, msg.author_avatar)
+    else:
+        avatar_url = ' '
 
-    with open('util/template.html', 'r') as t_file:
-        template = ' '.join(t_file.readlines())
 
+    # replace line breakes with separate <p> tags in html
+    msg_text = msg.content.replace('\n', "</br>\n           ")
+    #msg_text = msg_text.replace('\n', '</p>\n           <p>')
 
-    for msg in reversed(messages):
-        h_type = ' '
-        h_class = 'left'
+    parts = [_render_msg_head(h_type, avatar_url, msg.author_name, msg_text)]
 
-        # victim_id is default values
-        if msg.author.id == offender_id:
-            h_type = 'offender'
-            h_class = 'left'
-        elif msg.author.id == bot_id:
-            h_type = 'bot'
-            h_class = 'right'
-        elif _is_member_steward(msg.author, steward_id):
-            h_type = 'steward'
-            h_class = 'right'
 
+    missed_attachments = 0
 
-        if msg.author.avatar:
-            avatar_url = 'https://cdn.discordapp.com/avatars/{:d}/{:s}.png'.format(msg.author.id, msg.author.avatar)
+    for img_src in images:
+        if img_src is not None:
+            parts.append(_render_attachment(img_src))
         else:
-            avatar_url = ' '
+            missed_attachments += 1
 
 
-        nickname = msg.author.display_name
-        time_hour_str = msg.created_at.strftime('%H:%M')
-        time_day_str = msg.created_at.strftime('%d.%m.%y')
+    embed_content = None
+    missed_embeds = 0
 
-        img_content = None
+    for embed in msg.embeds:
+        if embed['type'] == 'rich' and embed['description'] is not None:
+            # only the last rich embed is displayed
+            embed_content = embed
+        else:
+            missed_embeds += 1
 
+    if embed_content:
+        parts.append(_gen_embed(embed_content))
 
-        embed_content = ''
-        embed_placeholder = None
-        missed_embeds = 0
 
-        for embed in msg.embeds:
-            if embed.type == 'rich' and embed.description != discord.Embed.Empty:
-                embed_content = '			<div class="embed">\n'\
-                                '  			  <div></div>\n'\
-                                '  			    <div>\n'\
-                                '                 <h3>{:s}</h3>\n'\
-                                '                 <p>{:s}</p>\n'\
-                                '                   <div class="content">\n'.format(embed.title, embed.description)
+    if missed_embeds != 0:
+        parts.append(_render_paragraph('[{:d} embed(s) not displayed]'.format(len(msg.embeds))))
 
-                fields_left = []
-                fields_right = []
-                toggle = True
+    if missed_attachments > 0:
+        parts.append(_render_paragraph('[{:d} attachment(s) not displayed]'.format(missed_attachments)))
 
-                for field in embed.fields:
 
-                    if toggle:
-                        fields_left.append(field)
-                        toggle = False
-                    else:
-                        fields_right.append(field)
-                        toggle = True
+    parts.append(_render_msg_tail(msg.created_at.strftime('%H:%M'), msg.created_at.strftime('%d.%m.%y')))
 
+    return parts
 
 
-                embed_content += _gen_embed_column(fields_left)
-                embed_content += _gen_embed_column(fields_right)
 
 
-                embed_content += '                 </div>\n'\
-                                 '               </div>\n'\
-                                 '           </div>\n'
 
+def _is_image(attachment):
+    # an attachment could be any file supported by discord
+    # but base64 embed is currently only used for jpg/png
+    return attachment['filename'].endswith('jpg') or attachment['filename'].endswith('png')
 
-            else:
-                missed_embeds += 1
 
+def inline_image(content: bytes, filename: str):
+    """embed the image as base64 data uri, the report stays a single file"""
+    return 'data:image/png;base64,{:s}'.format(base64.b64encode(content).decode('utf-8'))
 
-        if missed_embeds != 0:
-            embed_placeholder = '[{:d} embed(s) not displayed]'.format(len(msg.embeds))
 
+def _store_image(content: bytes, filename: str, image_src):
+    # runs in the default executor, hashing and writing multi-MB images would stall the event loop
+    # hash of the image as stored in the report, the blob name in archive mode
+    return hashlib.sha256(content).hexdigest(), image_src(content, filename)
 
 
-        img_content = ''
-        attach_placeholder = None
-        missed_attachments = 0
+async def _fetch_image(attachment, downloader, compressor, image_src):
+    content = await downloader.fetch(attachment['url'])
 
-        for img in msg.attachments:
-            # an attachment could be any file supported by discord
-            # but base64 embed is currently only used for jpg/png
-            if img.filename.endswith('jpg') or img.filename.endswith('png'):
-                img_base64 = base64.b64encode(requests.get(img.proxy_url).content)
-                img_content += '           <img alt="" src="data:image/png;base64,{:s}" />\n'.format(img_base64.decode('utf-8'))
-            else:
-                missed_attachments += 1
+    if content is None:
+        return None
 
+    filename = attachment['filename']
 
-        if missed_attachments > 0:
-            attach_placeholder = '[{:d} attachment(s) not displayed]'.format(missed_attachments)
+    if compressor:
+        content, filename = await compressor.compress(content, filename)
 
+    return await asyncio.get_event_loop().run_in_executor(None, _store_image, content, filename, image_src)
 
-        # replace line breakes with separate <p> tags in html
-        msg_text = msg.clean_content.replace('\n', "</br>\n           ")
-        #msg_text = msg_text.replace('\n', '</p>\n           <p>')
 
+def _prefetch_images(msg, downloader, compressor, image_src):
+    # one download per attachment, None for attachments which are not displayed
+    return [asyncio.ensure_future(_fetch_image(a, downloader, compressor, image_src)) if _is_image(a) else None for a in msg.attachments]
 
-        template += '   <div class="container {:s}">\n'\
-                    '       <div class="avatar mr-25">\n'\
-                    '           <img class="row imgProfile" src="{:s}" alt="Avatar">\n'\
-                    '           <span class="row name">{:s}</span>\n'\
-                    '       </div>\n'\
-                    '\n'\
-                    '       <div class="comments mr-25">\n'\
-                    '           <p>{:s}</p>\n'.format(h_type, avatar_url, nickname, msg_text)
 
-        if img_content != '':
-            template += img_content
+async def _render(msg, downloads, exporters, victim_id, offender_id, steward_id, bot_id):
+    # the downloads are already running concurrently
+    # (sha256, img src) of each attachment
+    results = [(await d) if d is not None else None for d in downloads]
 
-        if embed_content != '':
-            template += embed_content
+    author_role = get_author_role(msg, victim_id, offender_id, steward_id, bot_id)
 
-        if embed_placeholder:
-            template += '           <p>{:s}</p>\n'.format(embed_placeholder)
+    if exporters:
+        hashes = [res[0] if res is not None else None for res in results]
 
-        if attach_placeholder:
-            template += '           <p>{:s}</p>\n'.format(attach_placeholder)
+        for exporter in exporters:
+            exporter.add_message(msg, author_role, hashes)
 
+    images = [res[1] if res is not None else None for res in results]
 
-        template += '       </div>'\
-                    '\n'\
-                    '       <div class="time row">\n'\
-                    '           <p>{:s}</br>\n'\
-                    '           {:s}</p>\n'\
-                    '       </div>\n'\
-                    '   </div>\n\n'.format(time_hour_str, time_day_str)
+    return _gen_message(msg, author_role, images)
+
+
+async def write_html_report(fp, downloader, messages, victim_id, offender_id, steward_id, bot_id, image_src=inline_image, compressor=None, exporters=[]):
+    """render messages (async iterable of TranscriptMessage, oldest first) as html into the file-like object fp
+       each message is written as soon as it is rendered,
+       the report is never held in memory as a whole
+
+       each message is also passed to the exporters (e.g. NdjsonExporter),
+       as add_message(msg, author_role, attachment_hashes)
+
+       the attachments of the next prefetch_window messages
+       are downloaded concurrently by the downloader,
+       and downscaled by the compressor (ImageCompressor), if given
+
+       image_src(content, filename) returns the img src of a downloaded image,
+       e.g. BlobStore.put to reference the images instead of inlining them
+       it's called in the default executor, concurrently for multiple images
+
+    Returns:
+        int: number of exported messages
+    """
+
+    fp.write(_get_template())
+
+    pending = deque()
+    msg_cnt = 0
 
+    try:
+        async for msg in messages:
+            msg_cnt += 1
+            pending.append((msg, _prefetch_images(msg, downloader, compressor, image_src)))
 
+            if len(pending) > prefetch_window:
+                fp.writelines(await _render(*pending.popleft(), exporters, victim_id, offender_id, steward_id, bot_id))
 
-    template += ' </body>\n</html>\n'
+        while pending:
+            fp.writelines(await _render(*pending.popleft(), exporters, victim_id, offender_id, steward_id, bot_id))
 
+    finally:
+        # don't leave downloads running, if rendering failed
+        for _, downloads in pending:
+            for task in downloads:
+                if task is not None:
+                    task.cancel()
 
-    return template
+    fp.write(' </body>\n</html>\n')
 
+    return msg_cnt
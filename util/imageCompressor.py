@@ -0,0 +1,100 @@
+import io
+import os
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# images wider than this are downscaled, unset disables the pipeline
+max_width = int(os.getenv('REPORT_IMAGE_MAX_WIDTH', '0'))
+jpeg_quality = int(os.getenv('REPORT_IMAGE_QUALITY', '80'))
+compress_workers = int(os.getenv('REPORT_IMAGE_WORKERS', '2'))
+
+
+def _compress(content: bytes, filename: str, max_width: int, quality: int):
+    """runs in a worker process
+
+    Returns:
+        (bytes, str): compressed image and its new filename
+    """
+
+    img = Image.open(io.BytesIO(content))
+
+    if img.width > max_width:
+        img = img.resize((max_width, max(1, round(img.height * max_width / img.width))), Image.LANCZOS)
+
+    out = io.BytesIO()
+    base = os.path.splitext(filename)[0]
+
+    # transparency would be lost as jpg
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img.save(out, format='PNG', optimize=True)
+        filename = base + '.png'
+    else:
+        img.convert('RGB').save(out, format='JPEG', quality=quality, optimize=True)
+        filename = base + '.jpg'
+
+    return out.getvalue(), filename
+
+
+class ImageCompressor:
+    """downscales and recompresses report images in a process pool,
+       doesn't block the event loop
+
+       disabled if REPORT_IMAGE_MAX_WIDTH is not set or Pillow is not installed
+    """
+
+    def __init__(self):
+        self.enabled = max_width > 0 and Image is not None
+        self._executor = None
+
+        if max_width > 0 and Image is None:
+            print('REPORT_IMAGE_MAX_WIDTH is set, but Pillow is not installed. Images are not compressed')
+
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+    async def compress(self, content: bytes, filename: str):
+        """
+        Returns:
+            (bytes, str): the smaller of the compressed and the original image, with its filename
+        """
+
+        if not self.enabled:
+            return content, filename
+
+        if self._executor is None:
+            # forking would copy the event loop, open sockets and the mongo client of the bot
+            self._executor = ProcessPoolExecutor(max_workers=compress_workers, mp_context=multiprocessing.get_context('spawn'))
+
+        executor = self._executor
+        loop = asyncio.get_event_loop()
+
+        try:
+            compressed, new_name = await loop.run_in_executor(executor, _compress, content, filename, max_width, jpeg_quality)
+        except BrokenProcessPool as e:
+            # a worker died (e.g. killed on oom), the pool is unusable from now on
+            # it's recreated with the next image, unless another task already did
+            print(f'failed to compress {filename}: {e!r}')
+            if self._executor is executor:
+                self.close()
+            return content, filename
+        except Exception as e:
+            # broken or unsupported image, keep it as it is
+            print(f'failed to compress {filename}: {e!r}')
+            return content, filename
+
+        if len(compressed) >= len(content):
+            return content, filename
+
+        return compressed, new_name
@@ -0,0 +1,58 @@
+import discord
+
+from lib.lruCache import LRUCache
+
+
+class MemberResolver:
+    """resolves guild members with as few api calls as possible
+
+       1. gateway member cache (members intent)
+       2. members fetched within the last 10 minutes
+       3. guild.fetch_member (REST)
+    """
+
+    # fetched members, keyed by (guild id, user id)
+    cache = LRUCache(512, ttl=10*60)
+
+    gateway_hits = 0
+    fetches = 0
+
+    @staticmethod
+    async def get_member(guild: discord.Guild, user_id: int):
+        """same as guild.fetch_member, but prefers cached members
+
+        Raises:
+            discord.errors.NotFound: user is not a member of the guild
+        """
+
+        member = guild.get_member(user_id)
+
+        if member:
+            MemberResolver.gateway_hits += 1
+            return member
+
+        key = (guild.id, user_id)
+        member = MemberResolver.cache.get(key)
+
+        if member:
+            return member
+
+        member = await guild.fetch_member(user_id)
+        MemberResolver.fetches += 1
+
+        MemberResolver.cache.put(key, member)
+        return member
+
+
+    @staticmethod
+    def get_stats():
+        """hit counters of all resolution steps"""
+
+        cache_stats = MemberResolver.cache.stats()
+
+        return {
+            'gateway_hits': MemberResolver.gateway_hits,
+            'cache_hits': cache_stats['hits'],
+            'cache_size': cache_stats['size'],
+            'fetches': MemberResolver.fetches
+        }
@@ -0,0 +1,45 @@
+import json
+
+
+def _isoformat(ts):
+    return ts.isoformat() if ts else None
+
+
+class NdjsonExporter:
+    """writes one json object per message and line into fp
+       fp is usually a gzip file opened in text mode (gzip.open(path, 'wt'))
+
+       used as exporter of write_html_report, fed by the same message iteration
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+
+
+    def add_message(self, msg, author_role: str, attachment_hashes: []):
+        """
+        Args:
+            msg (TranscriptMessage): exported message
+            author_role (str): offender, bot, steward, victim or other
+            attachment_hashes ([str]): sha256 of each attachment, as stored in the report (i.e. after compression)
+                only png/jpg images are downloaded, the hash of all other attachments
+                and of failed downloads is None
+        """
+
+        attachments = [{'filename': a['filename'], 'url': a['url'], 'sha256': h} for a, h in zip(msg.attachments, attachment_hashes)]
+
+        d = dict({
+            'm_id': msg.m_id,
+            'channel_id': msg.channel_id,
+            'author_id': msg.author_id,
+            'author_name': msg.author_name,
+            'author_role': author_role,
+            'created_at': _isoformat(msg.created_at),
+            'edited_at': _isoformat(msg.edited_at),
+            'content': msg.content,
+            'embeds': msg.embeds,
+            'attachments': attachments
+        })
+
+        self.fp.write(json.dumps(d, ensure_ascii=False, separators=(',', ':')))
+        self.fp.write('\n')
@@ -0,0 +1,85 @@
+import time
+import asyncio
+from collections import deque
+
+import discord
+
+
+class RenameQueue:
+    """renames channels in the background, without blocking the caller
+
+       discord only allows 2 renames per channel every 10 minutes,
+       only the latest requested name is applied once the limit allows it
+    """
+
+    rate = 2
+    per = 10*60  # seconds
+
+    def __init__(self):
+        self._pending = {}  # channel id: (channel, name)
+        self._history = {}  # channel id: timestamps of the last renames
+        self._workers = {}  # channel id: running worker task
+
+
+    def request(self, channel, name: str):
+        """rename the channel as soon as the rate limit allows it
+           replaces any pending rename of the same channel
+        """
+
+        self._pending[channel.id] = (channel, name)
+
+        if channel.id not in self._workers:
+            self._workers[channel.id] = asyncio.create_task(self._worker(channel.id))
+
+
+    def cancel(self, channel_id: int):
+        """drop the pending rename of the channel, if any
+           used once the channel is deleted
+        """
+        self._pending.pop(channel_id, None)
+        self._history.pop(channel_id, None)
+
+
+    def cancel_all(self):
+        for task in self._workers.values():
+            task.cancel()
+
+
+    async def _worker(self, channel_id: int):
+        history = self._history.setdefault(channel_id, deque(maxlen=RenameQueue.rate))
+
+        try:
+            while channel_id in self._pending:
+
+                # wait until the oldest rename left the rate limit window
+                if len(history) == RenameQueue.rate:
+                    delay = history[0] + RenameQueue.per - time.monotonic()
+
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+                # the latest name might have changed while sleeping
+                pending = self._pending.pop(channel_id, None)
+                if not pending:
+                    break
+
+                channel, name = pending
+
+                try:
+                    await channel.edit(name=name)
+                except discord.errors.NotFound:
+                    # channel was deleted meanwhile
+                    break
+                except discord.errors.HTTPException as e:
+                    print(f'failed to rename channel {channel_id}:')
+                    print(e)
+
+                history.append(time.monotonic())
+
+        finally:
+            # removed synchronously, a new request always starts a new worker
+            self._workers.pop(channel_id, None)
+
+            # the history is not needed anymore, once the window expired
+            if history and history[-1] + RenameQueue.per < time.monotonic():
+                self._history.pop(channel_id, None)